@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+ログイン性能ベンチマーク
+パスワードハッシュの計算時間と、稼働中サーバーへの同時ログインのスループットを計測する
+
+実行方法:
+    # ハッシュ計算のみ（反復回数は PASSWORD_HASH_ROUNDS で変更可能）
+    python benchmark_login.py hash --iterations 20
+
+    # 稼働中サーバーへの同時ログイン
+    python benchmark_login.py login --url http://localhost:8000 --email admin@smartbuilder.ai --password password --requests 50 --concurrency 10
+
+注意:
+    - login は実際のログインAPIを呼び出すため、本番環境では実行しないでください
+"""
+import time
+import asyncio
+import argparse
+import statistics
+import httpx
+from passlib.context import CryptContext
+import config
+
+def benchmark_hash(iterations: int):
+    """pbkdf2_sha256のハッシュ化・検証にかかる時間を計測"""
+    context = CryptContext(schemes=["pbkdf2_sha256"], pbkdf2_sha256__default_rounds=config.PASSWORD_HASH_ROUNDS)
+    print(f"rounds: {config.PASSWORD_HASH_ROUNDS}")
+
+    hash_times = []
+    verify_times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        hashed = context.hash("benchmark-password")
+        hash_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        context.verify("benchmark-password", hashed)
+        verify_times.append(time.perf_counter() - start)
+
+    for name, times in (("hash", hash_times), ("verify", verify_times)):
+        print(f"{name:>6}: 平均 {statistics.mean(times) * 1000:.1f}ms / 最大 {max(times) * 1000:.1f}ms")
+    print(f"1スレッドあたりの最大ログイン数: {1 / statistics.mean(verify_times):.1f} 回/秒")
+
+async def benchmark_login(url: str, email: str, password: str, requests: int, concurrency: int):
+    """同時ログインのスループットとレイテンシを計測"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    statuses = {}
+
+    async with httpx.AsyncClient(base_url=url, timeout=60.0) as client:
+        async def login_once():
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.post("/login", data={"email": email, "password": password})
+                latencies.append(time.perf_counter() - start)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(login_once() for _ in range(requests)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print(f"requests: {requests} / concurrency: {concurrency}")
+    print(f"status: {statuses}")
+    print(f"throughput: {requests / elapsed:.1f} 回/秒")
+    print(f"latency: p50 {latencies[len(latencies) // 2] * 1000:.0f}ms / p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:.0f}ms / max {latencies[-1] * 1000:.0f}ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ログイン性能ベンチマーク")
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+
+    hash_parser = subparsers.add_parser("hash", help="ハッシュ計算時間を計測")
+    hash_parser.add_argument("--iterations", type=int, default=20)
+
+    login_parser = subparsers.add_parser("login", help="サーバーへの同時ログインを計測")
+    login_parser.add_argument("--url", default="http://localhost:8000")
+    login_parser.add_argument("--email", required=True)
+    login_parser.add_argument("--password", required=True)
+    login_parser.add_argument("--requests", type=int, default=50)
+    login_parser.add_argument("--concurrency", type=int, default=10)
+
+    args = parser.parse_args()
+    if args.mode == "hash":
+        benchmark_hash(args.iterations)
+    else:
+        asyncio.run(benchmark_login(args.url, args.email, args.password, args.requests, args.concurrency))
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+キャッシュ無効化バスの動作確認スクリプト（Firestoreエミュレーター用）
+他インスタンスからの無効化を変更ログに書き込み、このプロセスのキャッシュが破棄されることを確認する
+
+実行方法:
+    gcloud emulators firestore start --host-port=localhost:8080
+    FIRESTORE_EMULATOR_HOST=localhost:8080 GOOGLE_CLOUD_PROJECT=demo-test python check_cache_bus.py
+
+注意:
+    - 本番のFirestoreにデータを書き込まないよう、FIRESTORE_EMULATOR_HOST が未設定の場合は実行しません
+    - database.py が Cloud Storage クライアントも作成するため、アプリケーションのデフォルト認証情報が必要です
+"""
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from google.cloud import firestore
+
+if not os.getenv("FIRESTORE_EMULATOR_HOST"):
+    print("[ERROR] FIRESTORE_EMULATOR_HOST が設定されていません（エミュレーター専用のスクリプトです）")
+    sys.exit(1)
+
+from database import db
+from services import invalidation_service
+from services.invalidation_service import start_invalidation_listener, stop_invalidation_listener, publish_invalidation
+from services.user_service import get_user_doc, _user_cache
+from services.line_link_service import get_user_by_line_id, _line_user_cache
+from services.auth_service import _is_revoked
+import config
+
+def wait_until(condition, timeout: float = 10.0) -> bool:
+    """条件が満たされるまで待機"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.1)
+    return False
+
+def publish_from_other_instance(scope: str, key: str, value=None):
+    """別インスタンスの書き込みを模して変更ログに追加"""
+    db.collection(config.COL_CACHE_INVALIDATIONS).add({
+        "scope": scope,
+        "key": key,
+        "value": value,
+        "origin": "other-" + uuid.uuid4().hex,
+        "created_at": firestore.SERVER_TIMESTAMP,
+        "expire_at": datetime.now(timezone.utc) + timedelta(seconds=config.CACHE_BUS_RETENTION_SECONDS)
+    })
+
+def check(name: str, ok: bool) -> bool:
+    print(f"  {'[OK]' if ok else '[NG]'} {name}")
+    return ok
+
+def run_checks() -> bool:
+    print("=" * 60)
+    print("キャッシュ無効化バス 動作確認")
+    print("=" * 60)
+
+    user_id = "bus-check-" + uuid.uuid4().hex[:8]
+    line_user_id = "U" + uuid.uuid4().hex
+    db.collection(config.COL_USERS).document(user_id).set({"email": f"{user_id}@example.com", "token_version": 0})
+    db.collection(config.COL_LINE_USERS).document(line_user_id).set({"user_id": user_id})
+
+    start_invalidation_listener()
+    results = []
+    try:
+        get_user_doc(user_id)
+        get_user_by_line_id(line_user_id)
+
+        publish_from_other_instance("user", user_id)
+        results.append(check("他インスタンスの更新でユーザーキャッシュが破棄される",
+                             wait_until(lambda: _user_cache.get(user_id) is None)))
+
+        publish_from_other_instance("line_user", line_user_id)
+        results.append(check("他インスタンスの更新でLINE対応キャッシュが破棄される",
+                             wait_until(lambda: _line_user_cache.get(line_user_id) is None)))
+
+        get_user_doc(user_id)
+        db.collection(config.COL_USERS).document(user_id).update({"token_version": 1})
+        publish_from_other_instance("user", user_id)
+        results.append(check("他インスタンスのトークン失効（token_version の更新）が反映される",
+                             wait_until(lambda: _is_revoked({"sub": user_id, "ver": 0}))))
+
+        get_user_doc(user_id)
+        received = invalidation_service.get_invalidation_stats()["received"]
+        publish_invalidation("user", user_id)
+        time.sleep(2)
+        results.append(check("自分の書き込んだ無効化は無視される",
+                             _user_cache.get(user_id) is not None
+                             and invalidation_service.get_invalidation_stats()["received"] == received))
+    finally:
+        stop_invalidation_listener()
+        db.collection(config.COL_USERS).document(user_id).delete()
+        db.collection(config.COL_LINE_USERS).document(line_user_id).delete()
+
+    print(f"\n📊 結果: {sum(results)}/{len(results)} 件成功")
+    print(f"統計: {invalidation_service.get_invalidation_stats()}")
+    return all(results)
+
+if __name__ == "__main__":
+    sys.exit(0 if run_checks() else 1)
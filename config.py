@@ -16,7 +16,28 @@ STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY", "")
 
 # === JWT設定 ===
 ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24  # 24時間
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "60"))  # 期限切れ後はリフレッシュトークンで再発行
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "30"))  # アクセストークン再発行用
+
+# === パスワードハッシュ設定 ===
+PASSWORD_HASH_ROUNDS = int(os.getenv("PASSWORD_HASH_ROUNDS", "29000"))  # pbkdf2_sha256の反復回数（これ未満のハッシュはログイン時に再ハッシュ）
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))  # ハッシュ計算専用スレッド数
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "32"))  # 待ち行列の上限（超えたら503）
+
+# === メールアドレス索引設定 ===
+# 索引のない移行前ユーザーをクエリで探すか（migrate_email_index.py 実行後は false にする）
+EMAIL_INDEX_LEGACY_LOOKUP = os.getenv("EMAIL_INDEX_LEGACY_LOOKUP", "true").lower() == "true"
+
+# === LINE連携の対応キャッシュ設定 ===
+LINE_USER_CACHE_TTL_SECONDS = float(os.getenv("LINE_USER_CACHE_TTL_SECONDS", "300"))
+LINE_USER_CACHE_MAX_ENTRIES = int(os.getenv("LINE_USER_CACHE_MAX_ENTRIES", "10000"))
+# 対応ドキュメントのない移行前の連携をクエリで探すか（migrate_line_users.py 実行後は false にする）
+LINE_USER_INDEX_LEGACY_LOOKUP = os.getenv("LINE_USER_INDEX_LEGACY_LOOKUP", "true").lower() == "true"
+
+# === 使用回数の分散カウンター設定 ===
+USAGE_SHARDED_PLANS = ["enterprise", "unlimited"]  # 大量登録するプランは使用回数をシャードに分散
+USAGE_SHARD_COUNT = int(os.getenv("USAGE_SHARD_COUNT", "10"))  # 1ユーザーあたりのシャード数（約10件/秒まで）
+USAGE_APPROX_TTL_SECONDS = float(os.getenv("USAGE_APPROX_TTL_SECONDS", "10"))  # シャード合計の概算値を使い回す時間
 
 # === Cloud Storage設定 ===
 BUCKET_NAME = "my-receipt-app-storage-01"
@@ -24,15 +45,104 @@ BUCKET_NAME = "my-receipt-app-storage-01"
 # === Firestore コレクション名 ===
 COL_USERS = "users"
 COL_LINE_TOKENS = "line_tokens"
+COL_USAGE_SHARDS = "usage_shards"  # users/{id}/usage_shards/{n}（分散使用回数カウンター）
+COL_LINE_USERS = "line_users"  # line_users/{LINEユーザーID} → user_id（LINE連携の対応）
+COL_EMAILS = "emails"  # emails/{正規化したメールアドレスのSHA-256} → user_id（ログイン・重複チェック用）
+COL_LINE_EVENTS = "line_events"
+COL_PLATFORM_STATS = "platform_stats"  # platform_stats/summary（全体統計）
+COL_CACHE_INVALIDATIONS = "cache_invalidations"  # インスタンス間のキャッシュ無効化の変更ログ
+COL_RECORD_TOMBSTONES = "record_tombstones"  # users/{id}/record_tombstones（削除記録）
+COL_USER_STATS = "stats"  # users/{id}/stats/summary（集計）, users/{id}/stats/recent（最新一覧）
 
 # === ディレクトリ設定 ===
 UPLOAD_DIR = "uploads"
 FONT_DIR = "fonts"
 
+# === レコード一覧設定 ===
+RECORDS_PAGE_SIZE_DEFAULT = 50
+RECORDS_PAGE_SIZE_MAX = 200
+RECORDS_SORT_FIELDS = ["created_at", "date", "total_amount"]
+VENDOR_NGRAMS_MAX = 200  # 1レコードあたりの店舗名検索インデックス（n-gram）の上限
+VENDOR_SEARCH_SCAN_LIMIT = 1000  # 店舗名検索で候補として読み込むレコード数の上限
+RECENT_RECORDS_LIMIT = 50  # 初期表示用に保持する最新レコード数
+RECORDS_CHANGES_LIMIT = 500  # 差分同期で1回に返す最大件数
+RECORD_TOMBSTONE_RETENTION_DAYS = int(os.getenv("RECORD_TOMBSTONE_RETENTION_DAYS", "30"))  # 削除記録の保持期間（TTLポリシーで削除。これより古い基準時刻の差分同期は全件再取得）
+# APIレスポンス・エクスポートに含めない内部フィールド（検索インデックスなど）
+RECORD_INTERNAL_FIELDS = ["vendor_ngrams"]
+# fields= で指定できるフィールド（idは常に返す）
+RECORD_PROJECTABLE_FIELDS = [
+    "date", "vendor_name", "total_amount", "category", "image_url",
+    "is_pdf", "pdf_images", "original_filename", "source", "created_at"
+]
+
+# === 管理者ユーザー一覧設定 ===
+ADMIN_USERS_PAGE_SIZE_DEFAULT = 50
+ADMIN_USERS_PAGE_SIZE_MAX = 200
+# 一覧で読み込むフィールド（password は読み込まない）
+ADMIN_USER_LIST_FIELDS = ["email", "role", "created_at", "subscription", "line_user_id"]
+
+# === 全体統計（管理者ダッシュボード）設定 ===
+PLATFORM_STATS_MONTHS = int(os.getenv("PLATFORM_STATS_MONTHS", "12"))  # 月別の登録件数を集計する月数
+PLATFORM_STATS_REFRESH_SECONDS = int(os.getenv("PLATFORM_STATS_REFRESH_SECONDS", "3600"))  # これより古い集計は再計算
+PLATFORM_STATS_CACHE_SECONDS = float(os.getenv("PLATFORM_STATS_CACHE_SECONDS", "60"))  # 集計ドキュメントをインスタンス内で使い回す時間
+
+# === アップロード処理設定 ===
+SPOOL_MAX_MEMORY_BYTES = 4 * 1024 * 1024  # これを超えるダウンロードはディスクへ退避
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # ストリーミングダウンロードのチャンクサイズ
+
+# === LINE Webhook 設定 ===
+LINE_EVENT_DEDUP_TTL_SECONDS = 60 * 60 * 24  # 再送イベントの重複判定期間（24時間）
+LINE_EVENT_DEDUP_MEMORY_ENTRIES = 10000  # プロセス内に保持する処理済みイベント数
+LINE_WEBHOOK_WORKERS = int(os.getenv("LINE_WEBHOOK_WORKERS", "8"))  # イベント並列処理のワーカー数
+LINE_WEBHOOK_MAX_PENDING = int(os.getenv("LINE_WEBHOOK_MAX_PENDING", "100"))  # バックグラウンド処理の待ち上限（超えたら応答前にその場で処理）
+LINE_ALBUM_WINDOW_SECONDS = float(os.getenv("LINE_ALBUM_WINDOW_SECONDS", "3"))  # 連続画像をまとめる待機時間
+LINE_ALBUM_MAX_IMAGES = 20  # 1バッチにまとめる最大画像数
+
+# === LINE Messaging API HTTPクライアント設定 ===
+LINE_HTTP_MAX_CONNECTIONS = int(os.getenv("LINE_HTTP_MAX_CONNECTIONS", "20"))
+LINE_HTTP_MAX_KEEPALIVE = int(os.getenv("LINE_HTTP_MAX_KEEPALIVE", "10"))
+LINE_HTTP_KEEPALIVE_SECONDS = 60.0
+LINE_HTTP_TIMEOUT_SECONDS = float(os.getenv("LINE_HTTP_TIMEOUT_SECONDS", "10"))
+LINE_HTTP_CONNECT_TIMEOUT_SECONDS = 5.0
+LINE_HTTP_MAX_RETRIES = int(os.getenv("LINE_HTTP_MAX_RETRIES", "2"))
+LINE_HTTP_BACKOFF_SECONDS = 0.5  # 再試行の初回待機時間（指数バックオフ）
+LINE_HTTP_CALL_TIMEOUT_SECONDS = 60.0  # ワーカースレッドから呼び出す際の待機上限
+
+# === リアルタイム通知（SSE）設定 ===
+SSE_QUEUE_SIZE = int(os.getenv("SSE_QUEUE_SIZE", "100"))  # 接続ごとの未送信イベント上限（超えたら再同期を通知）
+SSE_HEARTBEAT_SECONDS = int(os.getenv("SSE_HEARTBEAT_SECONDS", "25"))  # 接続維持のための空コメント送信間隔
+SSE_RELAY_ENABLED = os.getenv("SSE_RELAY_ENABLED", "true").lower() == "true"  # 他インスタンスの変更をリスナーで受け取って配信
+SSE_RELAY_DEDUP_SECONDS = float(os.getenv("SSE_RELAY_DEDUP_SECONDS", "30"))  # 自インスタンスで配信済みの変更を中継で重複させない時間
+SSE_RELAY_CLOCK_SKEW_SECONDS = int(os.getenv("SSE_RELAY_CLOCK_SKEW_SECONDS", "2"))  # 接続時に遡って受け取る時間
+
+# === レスポンス圧縮設定 ===
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))  # これより小さいレスポンスは圧縮しない
+COMPRESSION_EXCLUDED_PATHS = ["/api/events", "/webhook"]  # 逐次送信・外部サービス向けのパス
+
+# === ユーザードキュメントキャッシュ設定 ===
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "300"))  # 無効化バスが止まっている場合に他インスタンスの更新が反映されるまでの最大時間
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "10000"))
+# 更新時に無効化バスで他インスタンスのキャッシュも破棄するフィールド（使用回数の加算などは対象外）
+USER_CACHE_BROADCAST_FIELDS = ["role", "subscription.plan", "subscription.limit", "subscription.status", "line_user_id", "token_version"]
+
+# === キャッシュ無効化バス設定 ===
+CACHE_BUS_ENABLED = os.getenv("CACHE_BUS_ENABLED", "true").lower() == "true"  # インスタンス間でキャッシュの無効化を共有
+CACHE_BUS_RETENTION_SECONDS = int(os.getenv("CACHE_BUS_RETENTION_SECONDS", "600"))  # 変更ログの保持期間（TTLポリシーで削除）
+CACHE_BUS_CLOCK_SKEW_SECONDS = int(os.getenv("CACHE_BUS_CLOCK_SKEW_SECONDS", "5"))  # 起動時に遡って受け取る時間
+
+# === Gemini 同時実行数 ===
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "4"))  # プロセス全体での同時解析数上限
+
 # === Gemini AI プロンプト ===
 GEMINI_PROMPT = """領収書を解析し [ { "date": "YYYY-MM-DD", "vendor_name": "...", "total_amount": 0 } ] のJSON形式で返せ。
 ※ 年が2桁(25, 26等)の場合は2025年, 2026年と解釈。和暦禁止。"""
 
+# 複数画像を1リクエストで解析する場合のプロンプト（{count}は画像枚数に置換）
+GEMINI_BATCH_PROMPT = """{count}枚の領収書画像を送付順に解析し、画像ごとの結果を配列にまとめて
+[ [ { "date": "YYYY-MM-DD", "vendor_name": "...", "total_amount": 0 } ], ... ] のJSON形式で返せ。
+外側の配列の要素数は必ず{count}とし、i番目の要素はi枚目の画像の結果とすること。
+※ 年が2桁(25, 26等)の場合は2025年, 2026年と解釈。和暦禁止。"""
+
 # === サブスクプラン定義 ===
 PLANS = {
     "free": {
@@ -12,7 +12,13 @@ storage_client = storage.Client()
 
 # === パスワードハッシュ設定 ===
 # pbkdf2_sha256を使用（Windows環境でbcryptのビルド問題を回避）
-pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
+# 反復回数が設定値未満のハッシュは needs_update 扱いになり、ログイン時に再ハッシュされる
+pwd_context = CryptContext(
+    schemes=["pbkdf2_sha256"],
+    deprecated="auto",
+    pbkdf2_sha256__default_rounds=config.PASSWORD_HASH_ROUNDS,
+    pbkdf2_sha256__min_rounds=config.PASSWORD_HASH_ROUNDS
+)
 
 def init_admin():
     """管理者アカウントの初期化（マルチユーザー構造）"""
@@ -20,6 +26,7 @@ def init_admin():
     if not admin_ref.get().exists:
         admin_ref.set({
             "email": "admin@smartbuilder.ai",
+            "email_normalized": "admin@smartbuilder.ai",
             "password": pwd_context.hash("password"),
             "role": "admin",
             "created_at": firestore.SERVER_TIMESTAMP,
@@ -36,4 +43,9 @@ def init_admin():
                 "cancel_at_period_end": False
             }
         })
+        # ログイン用のメールアドレス索引
+        db.collection(config.COL_EMAILS).document("admin@smartbuilder.ai").set({
+            "user_id": "admin",
+            "created_at": firestore.SERVER_TIMESTAMP
+        })
         print("[OK] 管理者アカウントを初期化しました")
@@ -11,9 +11,14 @@ from fastapi.staticfiles import StaticFiles
 # 設定とデータベース初期化
 import config
 from database import init_admin
+from services.line_client import line_client
+from services.invalidation_service import start_invalidation_listener, stop_invalidation_listener
+from utils.fast_json import FastJSONResponse
+from utils.compression import CompressionMiddleware
 
 # ルーター
-from routers import auth, records, line, export, admin
+from routers import auth, records, line, export, admin, events
+from routers.line import stop_webhook_workers
 
 # ディレクトリ作成
 os.makedirs(config.UPLOAD_DIR, exist_ok=True)
@@ -21,7 +26,7 @@ os.makedirs(config.FONT_DIR, exist_ok=True)
 os.makedirs("static", exist_ok=True)
 
 # FastAPI アプリケーション初期化
-app = FastAPI(title="SmartBuilder AI", version="2.0.0")
+app = FastAPI(title="SmartBuilder AI", version="2.0.0", default_response_class=FastJSONResponse)
 
 # 静的ファイルの配信
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -35,12 +40,20 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# レスポンス圧縮（brotli / gzip）
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=config.COMPRESSION_MIN_BYTES,
+    excluded_paths=config.COMPRESSION_EXCLUDED_PATHS,
+)
+
 # ルーター登録
 app.include_router(auth.router, tags=["認証"])
 app.include_router(records.router, tags=["レコード管理"])
 app.include_router(line.router, tags=["LINE連携"])
 app.include_router(export.router, tags=["エクスポート"])
 app.include_router(admin.router, tags=["管理者"])
+app.include_router(events.router, tags=["イベント配信"])
 
 # 基本エンドポイント
 @app.get("/")
@@ -61,9 +74,18 @@ async def startup_event():
     print("SmartBuilder AI - Starting...")
     print("=" * 50)
     init_admin()
+    await line_client.start()
+    start_invalidation_listener()
     print("[OK] Application ready!")
     print("=" * 50)
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """終了時処理"""
+    stop_webhook_workers()
+    stop_invalidation_listener()
+    await line_client.close()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+メールアドレス索引作成スクリプト
+既存ユーザーの emails/{正規化したメールアドレスのSHA-256} 索引と、管理画面の検索用の email_normalized を作成する
+正規化したメールアドレスをそのままIDにしていた旧形式の索引（email フィールドなし）は削除する
+
+実行方法:
+    python migrate_email_index.py
+
+注意:
+    - 実行後は環境変数 EMAIL_INDEX_LEGACY_LOOKUP=false を設定し、ログイン時のクエリを無効にしてください
+    - 正規化後に同じになるメールアドレスが複数ある場合は最初のユーザーのみ索引に登録し、重複を表示します
+"""
+from google.api_core.exceptions import AlreadyExists
+from google.cloud import firestore
+from database import db
+from services.user_service import email_ref, normalize_email
+import config
+
+def create_email_index():
+    """全ユーザーのメールアドレス索引を作成"""
+    print("=" * 60)
+    print("メールアドレス索引作成スクリプト")
+    print("=" * 60)
+
+    created_count = 0
+    normalized_count = 0
+    duplicates = []
+
+    for user_doc in db.collection(config.COL_USERS).stream():
+        user_data = user_doc.to_dict()
+        email = user_data.get("email")
+        if not normalize_email(email):
+            continue
+
+        # 管理画面の前方一致検索用
+        if user_data.get("email_normalized") != normalize_email(email):
+            user_doc.reference.update({"email_normalized": normalize_email(email)})
+            normalized_count += 1
+
+        ref = email_ref(email)
+        try:
+            ref.create({"user_id": user_doc.id, "email": normalize_email(email), "created_at": firestore.SERVER_TIMESTAMP})
+            created_count += 1
+        except AlreadyExists:
+            existing_user_id = ref.get().to_dict().get("user_id")
+            if existing_user_id != user_doc.id:
+                duplicates.append((email, existing_user_id, user_doc.id))
+
+    # 旧形式の索引を削除
+    removed_count = 0
+    for index_doc in db.collection(config.COL_EMAILS).stream():
+        if "email" not in index_doc.to_dict():
+            index_doc.reference.delete()
+            removed_count += 1
+
+    print(f"\n📊 結果: {created_count}件の索引を作成しました（email_normalized を{normalized_count}件設定、旧形式の索引を{removed_count}件削除）")
+    for email, existing_user_id, user_id in duplicates:
+        print(f"⚠️ 重複: {email} ({existing_user_id} / {user_id})")
+
+if __name__ == "__main__":
+    try:
+        create_email_index()
+    except KeyboardInterrupt:
+        print("\n\n❌ 処理が中断されました")
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""
+LINE連携対応ドキュメント作成スクリプト
+既存ユーザーの line_users/{LINEユーザーID} 対応ドキュメントを作成する
+
+実行方法:
+    python migrate_line_users.py
+
+注意:
+    - 実行後は環境変数 LINE_USER_INDEX_LEGACY_LOOKUP=false を設定し、画像受信時のクエリを無効にしてください
+"""
+from google.cloud import firestore
+from database import db
+from services.line_link_service import line_user_ref
+import config
+
+def create_line_user_mappings():
+    """LINE連携済みの全ユーザーの対応ドキュメントを作成"""
+    print("=" * 60)
+    print("LINE連携対応ドキュメント作成スクリプト")
+    print("=" * 60)
+
+    created_count = 0
+    for user_doc in db.collection(config.COL_USERS).where("line_user_id", "!=", None).stream():
+        line_user_id = user_doc.to_dict().get("line_user_id")
+        if not line_user_id:
+            continue
+        line_user_ref(line_user_id).set({"user_id": user_doc.id, "linked_at": firestore.SERVER_TIMESTAMP})
+        created_count += 1
+
+    print(f"\n📊 結果: {created_count}件の対応ドキュメントを作成しました")
+
+if __name__ == "__main__":
+    try:
+        create_line_user_mappings()
+    except KeyboardInterrupt:
+        print("\n\n❌ 処理が中断されました")
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+レコード正規化スクリプト
+既存レコードの日付・金額をサーバー側検索できる形式に揃え、店舗名検索インデックス（vendor_ngrams）と差分同期用の updated_at を補完する
+集計ドキュメント（users/{id}/stats/summary）・最新一覧（users/{id}/stats/recent）も作り直す
+
+実行方法:
+    python migrate_records.py
+
+注意:
+    - 本番環境で実行する前に、必ずバックアップを取得してください
+"""
+from google.cloud import firestore
+from database import db
+from services.record_service import rebuild_summary, rebuild_recent
+from utils.helpers import normalize_record_fields
+import config
+
+def normalize_existing_records():
+    """全ユーザーのレコードの日付(YYYY-MM-DD)・金額(整数)を正規化し、updated_atを補完"""
+    print("=" * 60)
+    print("レコード正規化スクリプト")
+    print("=" * 60)
+
+    updated_count = 0
+    checked_count = 0
+
+    for user_doc in db.collection(config.COL_USERS).stream():
+        batch = db.batch()
+        pending = 0
+
+        for record in user_doc.reference.collection("records").stream():
+            checked_count += 1
+            data = record.to_dict()
+            original = {k: data.get(k) for k in ("date", "total_amount", "vendor_name", "vendor_ngrams") if k in data}
+            normalized = normalize_record_fields(dict(original))
+
+            # 差分同期のため updated_at がないレコードは created_at で補完
+            if "updated_at" not in data:
+                normalized["updated_at"] = data.get("created_at") or firestore.SERVER_TIMESTAMP
+
+            if normalized != original:
+                batch.update(record.reference, normalized)
+                pending += 1
+                updated_count += 1
+
+            if pending >= 450:
+                batch.commit()
+                batch = db.batch()
+                pending = 0
+
+        if pending:
+            batch.commit()
+
+        # 月別・カテゴリ別の集計ドキュメントを作成
+        rebuild_summary(user_doc.id)
+        rebuild_recent(user_doc.id)
+        print(f"✅ {user_doc.id}: 確認済み")
+
+    print(f"\n📊 結果: {checked_count}件中 {updated_count}件を更新しました")
+
+if __name__ == "__main__":
+    try:
+        normalize_existing_records()
+    except KeyboardInterrupt:
+        print("\n\n❌ 処理が中断されました")
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+削除記録の有効期限設定スクリプト
+expires_at のない既存の削除記録（users/{id}/record_tombstones）に、削除日時から保持期間後の expires_at を設定する
+
+実行方法:
+    python migrate_tombstone_ttl.py
+
+注意:
+    - 事前に record_tombstones の expires_at にTTLポリシーを設定してください:
+        gcloud firestore fields ttls update expires_at --collection-group=record_tombstones --enable-ttl
+"""
+from datetime import datetime, timedelta, timezone
+from database import db
+import config
+
+def set_tombstone_expiry():
+    """既存の削除記録に expires_at を設定"""
+    print("=" * 60)
+    print("削除記録の有効期限設定スクリプト")
+    print("=" * 60)
+
+    retention = timedelta(days=config.RECORD_TOMBSTONE_RETENTION_DAYS)
+    updated_count = 0
+    batch = db.batch()
+    pending = 0
+
+    for doc in db.collection_group(config.COL_RECORD_TOMBSTONES).stream():
+        data = doc.to_dict()
+        if data.get("expires_at"):
+            continue
+        deleted_at = data.get("deleted_at") or data.get("updated_at") or datetime.now(timezone.utc)
+        batch.update(doc.reference, {"expires_at": deleted_at + retention})
+        pending += 1
+        updated_count += 1
+        if pending >= 450:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+
+    if pending:
+        batch.commit()
+
+    print(f"\n📊 結果: {updated_count}件の削除記録に expires_at を設定しました")
+
+if __name__ == "__main__":
+    try:
+        set_tombstone_expiry()
+    except KeyboardInterrupt:
+        print("\n\n❌ 処理が中断されました")
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+"""
+使用回数集計スクリプト
+分散カウンター（usage_shards）を使うプランの全ユーザーについて、シャードの合計を subscription.used に、
+集計シャード（stats/summary_{n}）を集計ドキュメントに繰り入れる
+
+実行方法:
+    python reconcile_usage.py
+
+注意:
+    - 定期実行（例: 1時間ごと）すると、画面に表示される使用回数と上限判定の誤差を小さく保てます
+"""
+from database import db
+from services.usage_service import reconcile_usage
+from services.record_service import fold_summary_shards
+import config
+
+def reconcile_all_usage():
+    """分散カウンター対象の全ユーザーの使用回数を集計"""
+    print("=" * 60)
+    print("使用回数集計スクリプト")
+    print("=" * 60)
+
+    reconciled_count = 0
+    query = db.collection(config.COL_USERS).where("subscription.plan", "in", config.USAGE_SHARDED_PLANS)
+    for user_doc in query.stream():
+        used = reconcile_usage(user_doc.id)
+        fold_summary_shards(user_doc.id)
+        print(f"  {user_doc.id}: {used}")
+        reconciled_count += 1
+
+    print(f"\n📊 結果: {reconciled_count}人の使用回数を集計しました")
+
+if __name__ == "__main__":
+    try:
+        reconcile_all_usage()
+    except KeyboardInterrupt:
+        print("\n\n❌ 処理が中断されました")
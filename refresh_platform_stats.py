@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+"""
+全体統計の再計算スクリプト
+集計クエリでプラン別ユーザー数・レコード総数・月別登録件数を求め、platform_stats/summary に保存する
+
+実行方法:
+    python refresh_platform_stats.py
+
+注意:
+    - Cloud Scheduler などで定期実行すると、管理画面の表示時に再計算が走らなくなります
+"""
+from services.platform_stats_service import compute_platform_stats
+
+def refresh_platform_stats():
+    """全体統計を再計算して表示"""
+    print("=" * 60)
+    print("全体統計の再計算スクリプト")
+    print("=" * 60)
+
+    stats = compute_platform_stats()
+    print(f"\nユーザー数: {stats['total_users']}")
+    for plan_id, count in stats["users_by_plan"].items():
+        print(f"  {plan_id}: {count}")
+    print(f"レコード数: {stats['total_records']}（合計金額 {stats['total_amount']:,}円）")
+    for month, entry in stats["by_month"].items():
+        print(f"  {month}: {entry['count']}件 / {entry['amount']:,}円")
+
+    print("\n📊 結果: 全体統計を保存しました")
+
+if __name__ == "__main__":
+    try:
+        refresh_platform_stats()
+    except KeyboardInterrupt:
+        print("\n\n❌ 処理が中断されました")
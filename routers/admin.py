@@ -2,45 +2,103 @@
 管理者ルーター
 ユーザー管理機能
 """
+from typing import Optional
 from fastapi import APIRouter, HTTPException, Depends
 from google.cloud import firestore
 from database import db
-from services.auth_service import get_current_user, hash_password
+from services.auth_service import hash_password_async, get_token_claims
+from services.user_service import (
+    update_user_claims, invalidate_user, get_user_cache_stats,
+    find_user_by_email, create_user_with_email, email_ref, normalize_email
+)
+from services.line_dedup_service import get_dedup_stats
+from services.usage_service import with_effective_usage, reconcile_usage
+from services.record_service import fold_summary_shards
+from services.line_link_service import line_user_ref, invalidate_line_user, get_line_link_cache_stats
+from services.event_service import event_broker
+from services.invalidation_service import get_invalidation_stats
+from services.platform_stats_service import get_platform_stats
 from utils.helpers import generate_user_id
 import config
 
 router = APIRouter()
 
-def require_admin(u_id: str = Depends(get_current_user)):
-    """管理者権限チェック"""
-    user_doc = db.collection(config.COL_USERS).document(u_id).get()
-    if not user_doc.exists:
-        raise HTTPException(status_code=404, detail="ユーザーが見つかりません")
-
-    user_data = user_doc.to_dict()
-    if user_data.get("role") != "admin":
+def require_admin(claims: dict = Depends(get_token_claims)):
+    """管理者権限チェック（トークンのロールクレームで判定。ロール変更は token_version で失効済み）"""
+    if claims.get("role") != "admin":
         raise HTTPException(status_code=403, detail="管理者権限が必要です")
 
-    return u_id
+    return claims.get("sub")
 
 @router.get("/admin/users")
-async def get_all_users(admin_id: str = Depends(require_admin)):
-    """全ユーザーの一覧を取得（管理者のみ）"""
-    users_ref = db.collection(config.COL_USERS).stream()
-    users = []
+async def get_all_users(
+    limit: int = config.ADMIN_USERS_PAGE_SIZE_DEFAULT,
+    cursor: Optional[str] = None,
+    plan: Optional[str] = None,
+    role: Optional[str] = None,
+    q: Optional[str] = None,
+    admin_id: str = Depends(require_admin)
+):
+    """ユーザー一覧をページ単位で取得（管理者のみ）
+
+    plan・role で絞り込み、q でメールアドレスの前方一致検索（正規化した email_normalized で比較）。
+    password は読み込まない。続きは next_cursor を cursor に渡して取得する。
+    """
+    if plan is not None and plan not in config.PLANS:
+        raise HTTPException(status_code=400, detail="無効なプランです")
+    if role is not None and role not in ("admin", "user"):
+        raise HTTPException(status_code=400, detail="roleはadminまたはuserを指定してください")
+
+    limit = max(1, min(limit, config.ADMIN_USERS_PAGE_SIZE_MAX))
+    prefix = normalize_email(q) if q else ""
+
+    # 絞り込み条件
+    query = db.collection(config.COL_USERS)
+    if plan:
+        query = query.where("subscription.plan", "==", plan)
+    if role:
+        query = query.where("role", "==", role)
+    if prefix:
+        query = query.where("email_normalized", ">=", prefix).where("email_normalized", "<", prefix + "\uf8ff")
+    filtered_query = query
+
+    # 検索時はメールアドレス順（カーソルは前ページ最後の正規化したメールアドレス）、それ以外はユーザーID順
+    if prefix:
+        query = query.order_by("email_normalized")
+        if cursor:
+            query = query.start_after({"email_normalized": cursor})
+    else:
+        query = query.order_by(firestore.FieldPath.document_id())
+        if cursor:
+            query = query.start_after({firestore.FieldPath.document_id(): db.collection(config.COL_USERS).document(cursor)})
+
+    # 一覧に必要なフィールドのみ読み込み、1件多く取得して次ページの有無を判定
+    docs = list(query.select(config.ADMIN_USER_LIST_FIELDS).limit(limit + 1).stream())
+    has_more = len(docs) > limit
+    docs = docs[:limit]
 
-    for user_doc in users_ref:
+    users = []
+    for user_doc in docs:
         user_data = user_doc.to_dict()
         users.append({
             "id": user_doc.id,
             "email": user_data.get("email", ""),
             "role": user_data.get("role", "user"),
             "created_at": user_data.get("created_at"),
-            "subscription": user_data.get("subscription", {}),
+            "subscription": with_effective_usage(user_doc.id, user_data),
             "line_user_id": user_data.get("line_user_id")
         })
 
-    return {"users": users}
+    next_cursor = None
+    if has_more and users:
+        next_cursor = normalize_email(users[-1]["email"]) if prefix else users[-1]["id"]
+
+    # 総件数は集計クエリで取得（1ページ目のみ）
+    total = None
+    if not cursor:
+        total = filtered_query.count(alias="total").get()[0][0].value
+
+    return {"users": users, "next_cursor": next_cursor, "has_more": has_more, "total": total}
 
 @router.post("/admin/users")
 async def create_user(data: dict, admin_id: str = Depends(require_admin)):
@@ -61,12 +119,8 @@ async def create_user(data: dict, admin_id: str = Depends(require_admin)):
         print("❌ Missing email or password")
         raise HTTPException(status_code=400, detail="メールアドレスとパスワードは必須です")
 
-    # メールアドレスの重複チェック
-    existing = db.collection(config.COL_USERS).where("email", "==", email).limit(1).stream()
-    existing_list = list(existing)
-    print(f"Existing users: {len(existing_list)}")
-
-    if existing_list:
+    # メールアドレスの重複チェック（移行前のユーザー分。新規作成時は索引で重複を防ぐ）
+    if find_user_by_email(email):
         print("❌ Email already exists")
         raise HTTPException(status_code=400, detail="このメールアドレスは既に登録されています")
 
@@ -79,12 +133,13 @@ async def create_user(data: dict, admin_id: str = Depends(require_admin)):
 
     # ユーザー作成
     try:
-        db.collection(config.COL_USERS).document(user_id).set({
+        created = create_user_with_email(user_id, {
             "email": email,
-            "password": hash_password(password),
+            "password": await hash_password_async(password),
             "role": "user",
             "created_at": firestore.SERVER_TIMESTAMP,
             "line_user_id": None,
+            "token_version": 0,
             "subscription": {
                 "plan": plan,
                 "status": "active",
@@ -97,8 +152,13 @@ async def create_user(data: dict, admin_id: str = Depends(require_admin)):
                 "cancel_at_period_end": False
             }
         })
+        if not created:
+            print("❌ Email already exists")
+            raise HTTPException(status_code=400, detail="このメールアドレスは既に登録されています")
         print(f"✅ User created successfully: {user_id}")
         return {"message": "ユーザーを作成しました", "user_id": user_id}
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"❌ Error creating user: {str(e)}")
         raise HTTPException(status_code=500, detail=f"ユーザー作成に失敗しました: {str(e)}")
@@ -110,16 +170,27 @@ async def delete_user(user_id: str, admin_id: str = Depends(require_admin)):
         raise HTTPException(status_code=403, detail="管理者アカウントは削除できません")
 
     user_ref = db.collection(config.COL_USERS).document(user_id)
-    if not user_ref.get().exists:
+    user_doc = user_ref.get()
+    if not user_doc.exists:
         raise HTTPException(status_code=404, detail="ユーザーが見つかりません")
 
-    # サブコレクションのレコードを全削除
-    records_ref = user_ref.collection("records").stream()
-    for record in records_ref:
-        record.reference.delete()
+    # サブコレクションのレコード・削除記録・集計を全削除
+    for subcollection in ("records", config.COL_RECORD_TOMBSTONES, config.COL_USER_STATS, config.COL_USAGE_SHARDS):
+        for doc in user_ref.collection(subcollection).stream():
+            doc.reference.delete()
 
-    # ユーザードキュメントを削除
-    user_ref.delete()
+    # ユーザードキュメントとメールアドレス索引を削除
+    batch = db.batch()
+    batch.delete(user_ref)
+    user_data = user_doc.to_dict()
+    if normalize_email(user_data.get("email")):
+        batch.delete(email_ref(user_data["email"]))
+    if user_data.get("line_user_id"):
+        batch.delete(line_user_ref(user_data["line_user_id"]))
+    batch.commit()
+    if user_data.get("line_user_id"):
+        invalidate_line_user(user_data["line_user_id"])
+    invalidate_user(user_id)
 
     return {"message": "ユーザーを削除しました"}
 
@@ -133,11 +204,46 @@ async def update_user_subscription(user_id: str, data: dict, admin_id: str = Dep
 
     plan = config.PLANS[plan_id]
 
-    # サブスク情報を更新
-    db.collection(config.COL_USERS).document(user_id).update({
+    # サブスク情報を更新（プランはトークンのクレームに含まれるため発行済みトークンを失効させる）
+    update_user_claims(user_id, {
         "subscription.plan": plan_id,
         "subscription.limit": plan["limit"],
         "subscription.status": "active"
     })
+    # 分散カウンターの対象が変わる場合に備え、使用回数・集計のシャードを繰り入れる
+    reconcile_usage(user_id)
+    fold_summary_shards(user_id)
+    event_broker.publish(user_id, "quota_changed", {"plan": plan_id, "limit": plan["limit"]})
 
     return {"message": "プランを更新しました"}
+
+@router.post("/admin/users/{user_id}/reconcile-usage")
+async def reconcile_user_usage(user_id: str, admin_id: str = Depends(require_admin)):
+    """分散カウンターを集計して使用回数・レコード集計を確定（管理者のみ）"""
+    used = reconcile_usage(user_id)
+    if used is None:
+        raise HTTPException(status_code=404, detail="ユーザーが見つかりません")
+    fold_summary_shards(user_id)
+    return {"message": "使用回数を集計しました", "used": used}
+
+@router.get("/admin/line-stats")
+async def get_line_stats(admin_id: str = Depends(require_admin)):
+    """LINE Webhookの重複排除統計・リアルタイム通知の接続数を取得（管理者のみ）"""
+    return {"dedup": get_dedup_stats(), "sse_subscribers": event_broker.subscriber_count()}
+
+@router.get("/admin/stats")
+async def get_admin_stats(refresh: bool = False, admin_id: str = Depends(require_admin)):
+    """プラン別ユーザー数・レコード総数・月別登録件数を取得（管理者のみ）
+
+    集計ドキュメントを返す。refresh=true で集計クエリを実行して作り直す。
+    """
+    return get_platform_stats(refresh=refresh)
+
+@router.get("/admin/cache-stats")
+async def get_cache_stats(admin_id: str = Depends(require_admin)):
+    """ユーザードキュメントキャッシュのヒット・ミス統計・無効化バスの状態を取得（管理者のみ）"""
+    return {
+        "user_cache": get_user_cache_stats(),
+        "line_user_cache": get_line_link_cache_stats(),
+        "invalidation_bus": get_invalidation_stats()
+    }
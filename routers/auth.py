@@ -5,8 +5,12 @@
 from fastapi import APIRouter, Form, HTTPException, Depends
 from google.cloud import firestore
 from database import db
-from services.auth_service import create_access_token, verify_password, hash_password, get_current_user
+from services.auth_service import create_user_tokens, decode_refresh_token, verify_password_async, hash_password_async
+from services.usage_service import with_effective_usage
+from services.record_service import public_record
+from services.user_service import get_fresh_user_context, get_user_doc, update_user, find_user_by_email, create_user_with_email
 from utils.helpers import generate_user_id
+from utils.fast_json import streaming_json_response
 import config
 
 router = APIRouter()
@@ -19,32 +23,33 @@ async def login(email: str = Form(...), password: str = Form(...)):
     print(f"[LOGIN] Email: {email}")
     print(f"[LOGIN] Password length: {len(password)}")
 
-    # メールアドレスでユーザーを検索
+    # メールアドレス索引からユーザーを取得（クエリなし）
     try:
-        users = db.collection(config.COL_USERS).where("email", "==", email).limit(1).stream()
-        user_list = list(users)
-        print(f"[LOGIN] Users found: {len(user_list)}")
+        found = find_user_by_email(email)
+        print(f"[LOGIN] User found: {found is not None}")
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"[ERROR] Database query failed: {str(e)}")
         raise HTTPException(status_code=500, detail="データベースエラーが発生しました")
 
-    if not user_list:
+    if not found:
         print("[ERROR] User not found")
         raise HTTPException(status_code=401, detail="メールアドレスまたはパスワードが正しくありません")
 
-    user_doc = user_list[0]
-    user_id = user_doc.id
-    user_data = user_doc.to_dict()
+    user_id, user_data = found
 
     print(f"[LOGIN] User ID: {user_id}")
     print(f"[LOGIN] User email in DB: {user_data.get('email')}")
     print(f"[LOGIN] User role: {user_data.get('role')}")
     print(f"[LOGIN] Password hash type: {user_data.get('password', '')[:15]}...")
 
-    # パスワード検証
+    # パスワード検証（専用スレッドで実行）
     try:
-        password_valid = verify_password(password, user_data["password"])
+        password_valid, new_hash = await verify_password_async(password, user_data["password"])
         print(f"[LOGIN] Password validation result: {password_valid}")
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"[ERROR] Password verification exception: {str(e)}")
         import traceback
@@ -55,18 +60,25 @@ async def login(email: str = Form(...), password: str = Form(...)):
         print("[ERROR] Invalid password - authentication failed")
         raise HTTPException(status_code=401, detail="メールアドレスまたはパスワードが正しくありません")
 
+    # 反復回数の古いハッシュは設定値で再ハッシュして保存
+    if new_hash:
+        try:
+            update_user(user_id, {"password": new_hash})
+            print("[LOGIN] Password hash upgraded")
+        except Exception as e:
+            print(f"[WARNING] Password rehash failed: {str(e)}")
+
     print("[OK] Login successful - generating token")
-    token = create_access_token({"sub": user_id})
-    print(f"[OK] Token generated (first 20 chars): {token[:20]}...")
+    tokens = create_user_tokens(user_id, user_data)
+    print(f"[OK] Token generated (first 20 chars): {tokens['access_token'][:20]}...")
     print("=" * 60)
-    return {"access_token": token, "token_type": "bearer", "user_id": user_id, "role": user_data.get("role", "user")}
+    return {**tokens, "user_id": user_id, "role": user_data.get("role", "user")}
 
 @router.post("/register")
 async def register(email: str = Form(...), password: str = Form(...)):
     """新規ユーザー登録"""
-    # メールアドレスの重複チェック
-    existing_users = db.collection(config.COL_USERS).where("email", "==", email).limit(1).stream()
-    if list(existing_users):
+    # 移行前のユーザー（索引なし）との重複チェック（索引の作成は create_user_with_email で保証）
+    if find_user_by_email(email):
         raise HTTPException(status_code=400, detail="このメールアドレスは既に登録されています")
 
     # 新規ユーザーID生成
@@ -86,57 +98,92 @@ async def register(email: str = Form(...), password: str = Form(...)):
     }
 
     # Firestoreに保存
-    db.collection(config.COL_USERS).document(user_id).set({
+    user_data = {
         "email": email,
-        "password": hash_password(password),
+        "password": await hash_password_async(password),
         "role": "user",
         "created_at": firestore.SERVER_TIMESTAMP,
         "line_user_id": None,
+        "token_version": 0,
         "subscription": initial_subscription
-    })
+    }
+    # メールアドレス索引と同時に作成（同時登録でも重複しない）
+    if not create_user_with_email(user_id, user_data):
+        raise HTTPException(status_code=400, detail="このメールアドレスは既に登録されています")
 
     # トークン生成
-    token = create_access_token({"sub": user_id})
+    tokens = create_user_tokens(user_id, user_data)
 
-    return {"access_token": token, "token_type": "bearer", "user_id": user_id, "message": "登録完了"}
+    return {**tokens, "user_id": user_id, "message": "登録完了"}
 
-@router.get("/api/status")
-async def get_status(u_id: str = Depends(get_current_user)):
-    """ユーザーのステータスとレコード一覧を取得（サブコレクション対応）"""
-    # ユーザー情報を取得
-    user_doc = db.collection(config.COL_USERS).document(u_id).get()
-    if not user_doc.exists:
-        raise HTTPException(status_code=404, detail="ユーザーが見つかりません")
+@router.post("/api/token/refresh")
+async def refresh_token(data: dict):
+    """リフレッシュトークンから最新のロールでアクセストークンを再発行"""
+    payload = decode_refresh_token(data.get("refresh_token") or "")
+    user_id = payload.get("sub")
+
+    # 最新のロール・トークンバージョンを反映するためキャッシュを使わずに読む
+    user_data = get_user_doc(user_id, use_cache=False)
+    if user_data is None:
+        raise HTTPException(status_code=401, detail="Invalid token")
 
-    user_data = user_doc.to_dict()
-    subscription = user_data.get("subscription", {})
+    return {**create_user_tokens(user_id, user_data), "user_id": user_id, "role": user_data.get("role", "user")}
 
-    # サブコレクションからレコードを取得
-    records = []
-    records_ref = db.collection(config.COL_USERS).document(u_id).collection("records").stream()
+@router.get("/api/profile")
+async def get_profile(user_data: dict = Depends(get_fresh_user_context)):
+    """プロフィール・サブスク・LINE連携状態を取得（ユーザードキュメント1件の読み込みのみ）
 
-    for record in records_ref:
-        data = record.to_dict()
-        data["id"] = record.id
-        records.append(data)
+    使用回数は他インスタンスでの加算も反映するため、キャッシュを使わずに読み込む。
+    """
+    u_id = user_data["id"]
+    subscription = with_effective_usage(u_id, user_data)
+
+    plan_id = subscription.get("plan", "free")
+    plan_info = config.PLANS.get(plan_id, config.PLANS["free"])
+    limit = subscription.get("limit", 10)
+    used = subscription.get("used", 0)
 
     return {
         "user_id": u_id,
         "email": user_data.get("email", ""),
         "role": user_data.get("role", "user"),
-        "subscription": subscription,
-        "records": records
+        "subscription": {
+            **subscription,
+            "plan": plan_id,
+            "plan_name": plan_info["name"],
+            "limit": limit,
+            "used": used,
+            "remaining": limit - used
+        },
+        "line_connected": user_data.get("line_user_id") is not None
     }
 
+@router.get("/api/status")
+async def get_status(user_data: dict = Depends(get_fresh_user_context)):
+    """ユーザーのステータスとレコード一覧を取得（旧API・全件取得）
+
+    プロフィールは /api/profile、レコードは /api/records（ページング）を利用すること。
+    """
+    u_id = user_data["id"]
+    subscription = with_effective_usage(u_id, user_data)
+
+    def iter_records():
+        records_ref = db.collection(config.COL_USERS).document(u_id).collection("records").stream()
+        for record in records_ref:
+            yield public_record(record.to_dict(), record.id)
+
+    # レコードは件数が多くなるため1件ずつストリーミングで返す
+    return streaming_json_response({
+        "user_id": u_id,
+        "email": user_data.get("email", ""),
+        "role": user_data.get("role", "user"),
+        "subscription": subscription
+    }, "records", iter_records())
+
 @router.get("/api/subscription")
-async def get_subscription(u_id: str = Depends(get_current_user)):
+async def get_subscription(user_data: dict = Depends(get_fresh_user_context)):
     """現在のサブスク状態を取得"""
-    user_doc = db.collection(config.COL_USERS).document(u_id).get()
-    if not user_doc.exists:
-        raise HTTPException(status_code=404, detail="ユーザーが見つかりません")
-
-    user_data = user_doc.to_dict()
-    subscription = user_data.get("subscription", {})
+    subscription = with_effective_usage(user_data["id"], user_data)
 
     plan_id = subscription.get("plan", "free")
     plan_info = config.PLANS.get(plan_id, config.PLANS["free"])
@@ -0,0 +1,49 @@
+"""
+イベント配信ルーター
+レコードの追加・更新・削除と使用回数の変化をServer-Sent Eventsで通知
+"""
+import asyncio
+from fastapi import APIRouter, Request, Depends
+from fastapi.responses import StreamingResponse
+from services.auth_service import get_current_user_from_query
+from services.event_service import event_broker, format_sse
+from services.event_relay_service import watch_user, unwatch_user
+import config
+
+router = APIRouter()
+
+@router.get("/api/events")
+async def stream_events(request: Request, u_id: str = Depends(get_current_user_from_query)):
+    """ユーザーのイベントをSSEで配信
+
+    EventSourceはヘッダーを付けられないため、トークンはクエリパラメータでも受け付ける。
+    """
+    queue = event_broker.subscribe(u_id)
+    # 他インスタンス（LINE Webhookなど）での変更もFirestoreのリスナーで受け取る
+    watch_user(u_id)
+
+    async def event_stream():
+        try:
+            # 接続直後に通知（クライアントはここで取りこぼし分を差分同期する）
+            yield format_sse({"type": "ready", "data": {}})
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=config.SSE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": ping\n\n"
+                    continue
+                yield format_sse(event)
+        finally:
+            event_broker.unsubscribe(u_id, queue)
+            unwatch_user(u_id)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
+        }
+    )
@@ -5,12 +5,12 @@ CSV/Excel/PDF出力機能
 """
 import os
 import time
-from typing import Optional, List
+from typing import List
 from fastapi import APIRouter, HTTPException, Depends
 from fastapi.responses import FileResponse
-from jose import JWTError, jwt
 from database import db
-from services.auth_service import get_current_user_optional, get_current_user
+from services.auth_service import get_current_user_from_query, get_current_user
+from services.record_service import public_record
 import config
 
 router = APIRouter()
@@ -46,24 +46,13 @@ def download_japanese_font():
 JAPANESE_FONT_PATH = download_japanese_font()
 
 @router.get("/api/export/csv")
-async def export_csv(token: Optional[str] = None, u_id: Optional[str] = Depends(get_current_user_optional)):
+async def export_csv(u_id: str = Depends(get_current_user_from_query)):
     """CSV出力（サブコレクション対応）"""
     import pandas as pd
 
-    # トークンパラメータがある場合はそれを使用
-    if token:
-        try:
-            payload = jwt.decode(token, config.SECRET_KEY, algorithms=[config.ALGORITHM])
-            u_id = payload.get("sub")
-        except JWTError:
-            raise HTTPException(status_code=401, detail="無効なトークンです")
-
-    if not u_id:
-        raise HTTPException(status_code=401, detail="認証が必要です")
-
     # サブコレクションからレコードを取得
     records_ref = db.collection(config.COL_USERS).document(u_id).collection("records").stream()
-    records = [r.to_dict() for r in records_ref]
+    records = [public_record(r.to_dict(), r.id) for r in records_ref]
 
     if not records:
         raise HTTPException(status_code=404, detail="データがありません")
@@ -75,24 +64,13 @@ async def export_csv(token: Optional[str] = None, u_id: Optional[str] = Depends(
     return FileResponse(csv_path, media_type="text/csv", filename=f"receipts_{u_id}.csv")
 
 @router.get("/api/export/excel")
-async def export_excel(token: Optional[str] = None, u_id: Optional[str] = Depends(get_current_user_optional)):
+async def export_excel(u_id: str = Depends(get_current_user_from_query)):
     """Excel出力（サブコレクション対応）"""
     import pandas as pd
 
-    # トークンパラメータがある場合はそれを使用
-    if token:
-        try:
-            payload = jwt.decode(token, config.SECRET_KEY, algorithms=[config.ALGORITHM])
-            u_id = payload.get("sub")
-        except JWTError:
-            raise HTTPException(status_code=401, detail="無効なトークンです")
-
-    if not u_id:
-        raise HTTPException(status_code=401, detail="認証が必要です")
-
     # サブコレクションからレコードを取得
     records_ref = db.collection(config.COL_USERS).document(u_id).collection("records").stream()
-    records = [r.to_dict() for r in records_ref]
+    records = [public_record(r.to_dict(), r.id) for r in records_ref]
 
     if not records:
         raise HTTPException(status_code=404, detail="データがありません")
@@ -118,24 +96,13 @@ async def export_excel(token: Optional[str] = None, u_id: Optional[str] = Depend
     return FileResponse(excel_path, media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", filename=f"receipts_{u_id}.xlsx")
 
 @router.get("/api/export/pdf")
-async def export_pdf(token: Optional[str] = None, u_id: Optional[str] = Depends(get_current_user_optional)):
+async def export_pdf(u_id: str = Depends(get_current_user_from_query)):
     """PDF出力（サブコレクション対応）"""
     from fpdf import FPDF
 
-    # トークンパラメータがある場合はそれを使用
-    if token:
-        try:
-            payload = jwt.decode(token, config.SECRET_KEY, algorithms=[config.ALGORITHM])
-            u_id = payload.get("sub")
-        except JWTError:
-            raise HTTPException(status_code=401, detail="無効なトークンです")
-
-    if not u_id:
-        raise HTTPException(status_code=401, detail="認証が必要です")
-
     # サブコレクションからレコードを取得
     records_ref = db.collection(config.COL_USERS).document(u_id).collection("records").stream()
-    records = [r.to_dict() for r in records_ref]
+    records = [public_record(r.to_dict(), r.id) for r in records_ref]
 
     if not records:
         raise HTTPException(status_code=404, detail="データがありません")
@@ -221,7 +188,7 @@ async def export_selected_csv(data: dict, u_id: str = Depends(get_current_user))
         doc_ref = db.collection(config.COL_USERS).document(u_id).collection("records").document(record_id)
         doc = doc_ref.get()
         if doc.exists:
-            records.append(doc.to_dict())
+            records.append(public_record(doc.to_dict(), doc.id))
 
     if not records:
         raise HTTPException(status_code=404, detail="データがありません")
@@ -251,7 +218,7 @@ async def export_selected_excel(data: dict, u_id: str = Depends(get_current_user
         doc_ref = db.collection(config.COL_USERS).document(u_id).collection("records").document(record_id)
         doc = doc_ref.get()
         if doc.exists:
-            records.append(doc.to_dict())
+            records.append(public_record(doc.to_dict(), doc.id))
 
     if not records:
         raise HTTPException(status_code=404, detail="データがありません")
@@ -294,7 +261,7 @@ async def export_selected_pdf(data: dict, u_id: str = Depends(get_current_user))
         doc_ref = db.collection(config.COL_USERS).document(u_id).collection("records").document(record_id)
         doc = doc_ref.get()
         if doc.exists:
-            records.append(doc.to_dict())
+            records.append(public_record(doc.to_dict(), doc.id))
 
     if not records:
         raise HTTPException(status_code=404, detail="データがありません")
@@ -5,24 +5,39 @@ LINE Bot Webhook・トークン管理
 import os
 import time
 import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import APIRouter, Request, HTTPException, Depends
+from fastapi.concurrency import run_in_threadpool
 from google.cloud import firestore
-from linebot import LineBotApi, WebhookHandler
+from linebot import WebhookParser
 from linebot.exceptions import InvalidSignatureError
-from linebot.models import MessageEvent, ImageMessage, TextMessage, TextSendMessage
+from linebot.models import MessageEvent, ImageMessage, TextMessage
 from database import db
 from services.auth_service import get_current_user
-from services.gemini_service import analyze_with_gemini_retry
+from services.gemini_service import analyze_batch_with_gemini_retry
 from services.image_service import compress_image
+from services.line_client import line_client, LineApiError
+from services.line_dedup_service import claim_event, release_event, finish_event, release_in_flight
+from services.line_album_service import album_aggregator
+from services.record_service import insert_records_transactional
 from services.storage_service import upload_to_gcs
-from utils.helpers import generate_token, get_user_by_line_id, check_usage_limit
+from services.user_service import get_user_context
+from services.quota_service import reserve_quota
+from services.line_link_service import get_user_by_line_id, link_line_user, unlink_line_user
+from utils.helpers import generate_token, make_upload_path, normalize_record_fields
 import config
 
 router = APIRouter()
 
 # LINE 設定
-line_bot_api = LineBotApi(config.LINE_CHANNEL_ACCESS_TOKEN)
-handler = WebhookHandler(config.LINE_CHANNEL_SECRET)
+parser = WebhookParser(config.LINE_CHANNEL_SECRET)
+
+# Webhookイベント処理用のワーカープール（解析の同時数はGemini側のリミッターで制御）
+_webhook_executor = ThreadPoolExecutor(max_workers=config.LINE_WEBHOOK_WORKERS, thread_name_prefix="line-webhook")
+_pending_lock = threading.Lock()
+_pending = 0
 
 @router.get("/api/line-token")
 async def generate_line_token(u_id: str = Depends(get_current_user)):
@@ -46,13 +61,8 @@ async def generate_line_token(u_id: str = Depends(get_current_user)):
     return {"token": token, "message": "LINEでこのトークンを送信してください"}
 
 @router.get("/api/line-status")
-async def get_line_status(u_id: str = Depends(get_current_user)):
+async def get_line_status(user_data: dict = Depends(get_user_context)):
     """LINE連携ステータスを取得"""
-    user_doc = db.collection(config.COL_USERS).document(u_id).get()
-    if not user_doc.exists:
-        raise HTTPException(status_code=404, detail="ユーザーが見つかりません")
-
-    user_data = user_doc.to_dict()
     line_user_id = user_data.get("line_user_id")
 
     return {
@@ -63,9 +73,8 @@ async def get_line_status(u_id: str = Depends(get_current_user)):
 @router.post("/api/line-disconnect")
 async def disconnect_line(u_id: str = Depends(get_current_user)):
     """LINE連携を解除"""
-    db.collection(config.COL_USERS).document(u_id).update({
-        "line_user_id": None
-    })
+    # 対応ドキュメントとキャッシュも削除
+    unlink_line_user(u_id)
 
     return {"message": "LINE連携を解除しました"}
 
@@ -75,14 +84,113 @@ async def webhook(request: Request):
     signature = request.headers.get("X-Line-Signature")
     body = await request.body()
     try:
-        handler.handle(body.decode("utf-8"), signature)
+        events = parser.parse(body.decode("utf-8"), signature)
     except InvalidSignatureError:
         raise HTTPException(status_code=400)
+
+    # 集約待ち・画像解析を待たずに応答する（遅いとLINEが再送するため）
+    overflow = dispatch_events(events)
+    # 待ち行列が上限に達している分は応答前にその場で処理する
+    for group_events in overflow:
+        await run_in_threadpool(_handle_events_in_order, group_events)
     return "OK"
 
-@handler.add(MessageEvent, message=TextMessage)
+def _ordering_key(event) -> str:
+    """順序を保証する単位（LINEユーザー / グループ / ルーム）"""
+    source = getattr(event, "source", None)
+    for attr in ("user_id", "group_id", "room_id"):
+        value = getattr(source, attr, None)
+        if value:
+            return value
+    return f"_event_{id(event)}"
+
+def dispatch_events(events: list) -> list:
+    """Webhookイベントをバックグラウンドのスレッドプールで並列処理（完了は待たない）
+
+    同一ユーザーのイベントは受信順に直列処理する。
+    待ち行列が LINE_WEBHOOK_MAX_PENDING に達した場合は投入せず、そのイベント群を返す。
+    """
+    global _pending
+    groups = OrderedDict()
+    for event in events:
+        groups.setdefault(_ordering_key(event), []).append(event)
+
+    overflow = []
+    for group_events in groups.values():
+        with _pending_lock:
+            if _pending >= config.LINE_WEBHOOK_MAX_PENDING:
+                overflow.append(group_events)
+                continue
+            _pending += 1
+        _webhook_executor.submit(_run_pending, group_events)
+    return overflow
+
+def _run_pending(events: list):
+    global _pending
+    try:
+        _handle_events_in_order(events)
+    finally:
+        with _pending_lock:
+            _pending -= 1
+
+def stop_webhook_workers():
+    """インスタンス終了時の処理（未着手のイベントを破棄し、処理中の処理権を解放）
+
+    解放したイベントはLINEの再送時に再処理される。
+    """
+    _webhook_executor.shutdown(wait=False, cancel_futures=True)
+    release_in_flight()
+
+def _handle_events_in_order(events: list):
+    """同一ユーザーのイベントを順番に処理（トークン連携→画像の順序を保つ）"""
+    # 連続する画像イベントはまとめてハンドラーに渡す
+    image_events = []
+    for event in events:
+        if isinstance(event, MessageEvent) and isinstance(event.message, ImageMessage):
+            image_events.append(event)
+            continue
+        if image_events:
+            _run_handler(handle_image_messages, image_events)
+            image_events = []
+        _run_handler(_dispatch_event, event)
+
+    if image_events:
+        _run_handler(handle_image_messages, image_events)
+
+def _run_handler(func, arg):
+    """ハンドラーを実行（例外は他のイベントに波及させない）"""
+    try:
+        func(arg)
+    except Exception as e:
+        print(f"❌ LINE event handling error: {type(e).__name__}: {str(e)}")
+        import traceback
+        traceback.print_exc()
+
+def _dispatch_event(event):
+    """イベント種別ごとにハンドラーを呼び出す"""
+    if not isinstance(event, MessageEvent):
+        return
+    if isinstance(event.message, TextMessage):
+        handle_text_message(event)
+    elif isinstance(event.message, ImageMessage):
+        handle_image_messages([event])
+
 def handle_text_message(event):
     """テキストメッセージハンドラー（トークン連携対応）"""
+    # 再送イベントの重複チェック
+    if not claim_event(event):
+        return
+
+    try:
+        _handle_text(event)
+    except Exception:
+        # 再送時に再処理できるよう処理権を解放
+        release_event(event)
+        raise
+    finally:
+        finish_event(event)
+
+def _handle_text(event):
     text = event.message.text
     line_user_id = event.source.user_id
 
@@ -97,137 +205,215 @@ def handle_text_message(event):
             if not token_data.get("used", False):
                 user_id = token_data["user_id"]
 
-                # ユーザーにline_user_idを紐付け
-                db.collection(config.COL_USERS).document(user_id).update({
-                    "line_user_id": line_user_id
-                })
+                # ユーザーにline_user_idを紐付け（対応ドキュメント・キャッシュも更新）
+                link_line_user(user_id, line_user_id)
 
                 # トークンを使用済みにする
                 db.collection(config.COL_LINE_TOKENS).document(text).update({"used": True})
 
-                line_bot_api.reply_message(
-                    event.reply_token,
-                    TextSendMessage(text="✅ LINE連携が完了しました！\n\n今後は画像を送信すると自動的に解析されます。")
-                )
+                _reply_text(event.reply_token, line_user_id, "✅ LINE連携が完了しました！\n\n今後は画像を送信すると自動的に解析されます。")
                 return
             else:
-                line_bot_api.reply_message(
-                    event.reply_token,
-                    TextSendMessage(text="❌ このトークンは既に使用されています。\n\nWebアプリから新しいトークンを生成してください。")
-                )
+                _reply_text(event.reply_token, line_user_id, "❌ このトークンは既に使用されています。\n\nWebアプリから新しいトークンを生成してください。")
                 return
         else:
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text="❌ 無効なトークンです。\n\nWebアプリで正しいトークンを確認してください。")
-            )
+            _reply_text(event.reply_token, line_user_id, "❌ 無効なトークンです。\n\nWebアプリで正しいトークンを確認してください。")
             return
 
     # トークン以外のテキストメッセージ
-    line_bot_api.reply_message(
-        event.reply_token,
-        TextSendMessage(text="画像を送信してください📷\n\nまたは、Webアプリで生成したトークンを送信してLINE連携を完了してください。")
-    )
-
-@handler.add(MessageEvent, message=ImageMessage)
-def handle_image_message(event):
-    """画像メッセージハンドラー（マルチユーザー対応）"""
-    print(f"=== LINE Image Message Received ===")
-    line_user_id = event.source.user_id
+    _reply_text(event.reply_token, line_user_id, "画像を送信してください📷\n\nまたは、Webアプリで生成したトークンを送信してLINE連携を完了してください。")
+
+def handle_image_messages(events: list):
+    """画像メッセージハンドラー（連続して届いた画像は1バッチにまとめて解析）"""
+    print(f"=== LINE Image Message Received ({len(events)}) ===")
+
+    # 再送イベントの重複チェック（ダウンロード・解析の前に実施）
+    events = [event for event in events if claim_event(event)]
+    if not events:
+        return
+
+    line_user_id = events[0].source.user_id
     print(f"LINE User ID: {line_user_id}")
 
-    # LINE User IDからユーザーを検索
+    # 集約期間内に届いた画像をまとめる（後続の画像はリーダーのバッチに合流）
+    batch_events = album_aggregator.submit(line_user_id, events)
+    if batch_events is None:
+        # 処理権の完了・解放はバッチを処理するリーダー側で行う
+        print("Image added to pending album batch")
+        return
+
+    try:
+        process_image_batch(line_user_id, batch_events)
+    except Exception:
+        # 途中で失敗した画像は再送時に再処理できるよう処理権を解放
+        for event in batch_events:
+            release_event(event)
+        raise
+    finally:
+        for event in batch_events:
+            finish_event(event)
+
+def _reply_text(reply_token: str, line_user_id: str, text: str):
+    """返信（リプライトークンが失効している場合はプッシュ送信）"""
+    try:
+        line_client.run(line_client.reply_text(reply_token, text))
+    except LineApiError as e:
+        print(f"[WARNING] Reply failed ({e.status_code}), falling back to push")
+        line_client.run(line_client.push_text(line_user_id, text))
+
+def process_image_batch(line_user_id: str, events: list):
+    """集約した画像をまとめて解析・保存し、1通のサマリーを返信"""
+    print(f"=== LINE Image Batch: {len(events)} images ===")
+    # 最も新しいイベントのリプライトークンを使用（集約待ちの間に失効しにくい）
+    reply_token = events[-1].reply_token
+
+    # LINE User IDからユーザーを検索（バッチにつき1回）
     user_id = get_user_by_line_id(line_user_id)
     print(f"Found User ID: {user_id}")
 
     if not user_id:
         print("❌ User not found")
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="❌ LINE連携が完了していません。\n\nWebアプリにログインして、トークンを生成・送信してください。")
-        )
+        _reply_text(reply_token, line_user_id, "❌ LINE連携が完了していません。\n\nWebアプリにログインして、トークンを生成・送信してください。")
         return
 
-    # 使用上限チェック
-    if not check_usage_limit(user_id):
+    # 使用回数を画像数分まとめて予約（バッチにつき1トランザクション、残り件数分だけ処理）
+    reservation = reserve_quota(user_id, len(events))
+    if reservation.granted == 0:
         print("❌ Usage limit exceeded")
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="❌ 月間上限に達しました。\n\nWebアプリからプランをアップグレードしてください。")
-        )
+        _reply_text(reply_token, line_user_id, "❌ 月間上限に達しました。\n\nWebアプリからプランをアップグレードしてください。")
         return
 
+    accepted = events[:reservation.granted]
+    skipped_count = len(events) - len(accepted)
+    # 使用回数として確定するのはFirestoreへの書き込みが確定した画像のみ
+    consumed = 0
+    committed = set()
+    temp_paths = []
+
     try:
-        print("📥 Downloading image...")
-        # 画像をダウンロード
-        message_content = line_bot_api.get_message_content(event.message.id)
-
-        # 一時保存
-        temp_path = os.path.join(config.UPLOAD_DIR, f"line_{int(time.time())}.jpg")
-        print(f"Saving to: {temp_path}")
-
-        # image_contentは既にバイナリデータ
-        with open(temp_path, "wb") as f:
-            f.write(message_content.content)
-
-        # 画像を圧縮
-        print("Compressing image...")
-        temp_path = compress_image(temp_path, max_size=(1920, 1080), quality=85)
-
-        print("☁️ Uploading to GCS...")
-        # GCSにアップロード
-        gcs_file_name = f"line_receipts/{int(time.time())}.jpg"
-        public_url = upload_to_gcs(temp_path, gcs_file_name)
-        print(f"GCS URL: {public_url}")
-
-        print("🤖 Analyzing with Gemini...")
-        # Gemini解析（リトライ機能付き）
-        data_list = analyze_with_gemini_retry(temp_path, max_retries=3)
-
-        print("💾 Saving to Firestore...")
-        # サブコレクションに保存
-        for item in (data_list if isinstance(data_list, list) else [data_list]):
-            doc_id = str(int(time.time()*1000))
-            time.sleep(0.001)
-            item.update({
-                "image_url": public_url,
-                "id": doc_id,
-                "created_at": firestore.SERVER_TIMESTAMP,
-                "is_pdf": False,
-                "pdf_images": [],
-                "category": "その他",
-                "source": "line"
-            })
-            db.collection(config.COL_USERS).document(user_id).collection("records").document(doc_id).set(item)
-
-        # 使用回数をインクリメント
-        db.collection(config.COL_USERS).document(user_id).update({
-            "subscription.used": firestore.Increment(1)
-        })
-
-        # 一時ファイル削除
-        os.remove(temp_path)
-        print("✅ Processing complete")
-
-        # 結果を通知
-        result_text = "✅ 解析完了しました！\n\n"
-        for item in (data_list if isinstance(data_list, list) else [data_list]):
-            result_text += f"📅 日付: {item.get('date', '不明')}\n"
-            result_text += f"🏪 店舗: {item.get('vendor_name', '不明')}\n"
-            result_text += f"💰 金額: ¥{item.get('total_amount', 0):,}\n\n"
-
-        result_text += "Webアプリで詳細を確認できます。"
-
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text=result_text)
-        )
+        # 1. ダウンロード・圧縮・GCSアップロード
+        prepared = []
+        failed_count = 0
+        for event in accepted:
+            try:
+                print(f"📥 Downloading image {event.message.id}...")
+                # ストリーミングで受信し、Webアップロードと同じ経路で圧縮
+                with line_client.run(line_client.download_content(event.message.id)) as spool:
+                    temp_path = compress_image(spool, output_path=make_upload_path("line", ".jpg"), max_size=(1920, 1080), quality=85)
+                temp_paths.append(temp_path)
+
+                gcs_file_name = f"line_receipts/{os.path.basename(temp_path)}"
+                public_url = upload_to_gcs(temp_path, gcs_file_name)
+                print(f"GCS URL: {public_url}")
+                prepared.append((event, temp_path, public_url))
+            except Exception as e:
+                print(f"❌ Image preparation failed ({event.message.id}): {str(e)}")
+                release_event(event)
+                failed_count += 1
+
+        # 2. Gemini一括解析
+        print("🤖 Analyzing with Gemini (batch)...")
+        results = analyze_batch_with_gemini_retry([path for _, path, _ in prepared], max_retries=3) if prepared else []
+
+        # 3. Firestoreへ一括書き込み（画像単位でまとめ、書き込み上限に近づいたら確定）
+        print("💾 Saving to Firestore (batch)...")
+        chunk_items = []
+        chunk_events = []
+        saved_items = []
+
+        for (event, temp_path, public_url), data_list in zip(prepared, results):
+            if data_list is None:
+                release_event(event)
+                failed_count += 1
+                continue
+
+            items = [_line_record(item, public_url) for item in data_list]
+            # Firestoreの書き込み上限（500件）に近づいたら集計・最新一覧と合わせて確定
+            if chunk_items and len(chunk_items) + len(items) > 450:
+                if _commit_chunk(user_id, chunk_items, chunk_events):
+                    consumed += len(chunk_events)
+                    committed.update(id(e) for e in chunk_events)
+                    saved_items.extend(chunk_items)
+                else:
+                    failed_count += len(chunk_events)
+                chunk_items, chunk_events = [], []
+            chunk_items.extend(items)
+            chunk_events.append(event)
+
+        # 残りのレコードを確定
+        if chunk_events:
+            if _commit_chunk(user_id, chunk_items, chunk_events):
+                consumed += len(chunk_events)
+                committed.update(id(e) for e in chunk_events)
+                saved_items.extend(chunk_items)
+            else:
+                failed_count += len(chunk_events)
+        print(f"✅ Batch complete: {consumed} images, {len(saved_items)} records")
+
+        # 4. サマリーを1通で返信
+        _reply_text(reply_token, line_user_id, _build_batch_summary(saved_items, consumed, failed_count, skipped_count))
 
     except Exception as e:
-        print(f"❌ LINE image processing error: {str(e)}")
+        print(f"❌ LINE image batch error: {str(e)}")
         import traceback
         traceback.print_exc()
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text=f"❌ 画像の解析に失敗しました。\n\nエラー: {str(e)}\n\n別の画像で再度お試しください。")
-        )
+        # 保存が確定していない画像は再送時に再処理できるよう処理権を解放
+        for event in accepted:
+            if id(event) not in committed:
+                release_event(event)
+        _reply_text(reply_token, line_user_id, f"❌ 画像の解析に失敗しました。\n\nエラー: {str(e)}\n\n別の画像で再度お試しください。")
+    finally:
+        # 保存できなかった画像の分を返却
+        reservation.commit(consumed)
+        for temp_path in temp_paths:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+def _line_record(item: dict, public_url: str) -> dict:
+    """解析結果をLINE経由のレコードに整形"""
+    doc_id = str(int(time.time()*1000))
+    time.sleep(0.001)
+    normalize_record_fields(item)
+    item.update({
+        "image_url": public_url,
+        "id": doc_id,
+        "created_at": firestore.SERVER_TIMESTAMP,
+        "updated_at": firestore.SERVER_TIMESTAMP,
+        "is_pdf": False,
+        "pdf_images": [],
+        "category": "その他",
+        "source": "line"
+    })
+    return item
+
+def _commit_chunk(user_id: str, items: list, events: list) -> bool:
+    """画像単位でまとめたレコードを確定（失敗したら画像の処理権を解放してFalse）"""
+    try:
+        insert_records_transactional(user_id, items)
+        return True
+    except Exception as e:
+        print(f"❌ Firestore batch write failed ({len(events)} images): {str(e)}")
+        for event in events:
+            release_event(event)
+        return False
+
+def _build_batch_summary(items: list, success_images: int, failed_count: int, skipped_count: int) -> str:
+    """バッチ処理結果のサマリー文面を作成"""
+    if success_images == 0:
+        text = "❌ 画像の解析に失敗しました。\n\n別の画像で再度お試しください。"
+    else:
+        text = f"✅ {success_images}枚の解析が完了しました！\n\n"
+        for item in items[:10]:
+            text += f"📅 {item.get('date', '不明')} 🏪 {item.get('vendor_name', '不明')}\n"
+            text += f"💰 ¥{item.get('total_amount', 0):,}\n\n"
+        if len(items) > 10:
+            text += f"…ほか{len(items) - 10}件\n\n"
+        total = sum(item.get("total_amount", 0) or 0 for item in items)
+        text += f"合計: ¥{total:,}（{len(items)}件）\n"
+
+    if failed_count:
+        text += f"\n⚠️ {failed_count}枚は解析できませんでした。"
+    if skipped_count:
+        text += f"\n⚠️ 月間上限のため{skipped_count}枚は処理されませんでした。"
+
+    return text.rstrip() + "\n\nWebアプリで詳細を確認できます。"
@@ -5,7 +5,8 @@
 import os
 import time
 import shutil
-from typing import List
+from datetime import datetime, timezone
+from typing import List, Optional
 from fastapi import APIRouter, UploadFile, File, HTTPException, Depends
 from google.cloud import firestore
 from database import db
@@ -13,11 +14,171 @@ from services.auth_service import get_current_user
 from services.gemini_service import analyze_with_gemini_retry
 from services.image_service import compress_image, convert_pdf_to_images
 from services.storage_service import upload_to_gcs, delete_from_gcs
-from utils.helpers import check_usage_limit
+from services.usage_service import increment_usage
+from services.quota_service import reserve_quota
+from services.record_service import (
+    get_record_changes, insert_records_transactional, update_record_transactional,
+    delete_record_transactional, get_summary, get_recent_records, search_records_by_vendor,
+    public_record
+)
+from utils.helpers import make_upload_path, normalize_date, normalize_amount, normalize_record_fields
 import config
 
 router = APIRouter()
 
+def parse_record_fields(fields: Optional[str]) -> list:
+    """fieldsパラメータを検証してフィールド名のリストに変換（未指定なら空リスト）"""
+    if not fields:
+        return []
+    field_list = [f.strip() for f in fields.split(",") if f.strip() and f.strip() != "id"]
+    invalid = [f for f in field_list if f not in config.RECORD_PROJECTABLE_FIELDS]
+    if invalid:
+        raise HTTPException(status_code=400, detail=f"指定できないフィールドです: {', '.join(invalid)}")
+    # idのみ指定された場合はドキュメントIDだけを読み込む
+    return field_list or [firestore.FieldPath.document_id()]
+
+@router.get("/api/records")
+async def list_records(
+    limit: int = config.RECORDS_PAGE_SIZE_DEFAULT,
+    cursor: Optional[str] = None,
+    order_by: Optional[str] = None,
+    direction: str = "desc",
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    category: Optional[str] = None,
+    amount_min: Optional[int] = None,
+    amount_max: Optional[int] = None,
+    fields: Optional[str] = None,
+    u_id: str = Depends(get_current_user)
+):
+    """レコード一覧をページ単位で取得（サーバー側で絞り込み・並び替え、カーソルページング）
+
+    fieldsにカンマ区切りでフィールド名を指定すると、そのフィールドのみ返す。
+    """
+    field_list = parse_record_fields(fields)
+
+    if direction not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="directionはascまたはdescを指定してください")
+
+    # 範囲検索するフィールドで並び替える必要がある（Firestoreの制約）
+    has_date_range = bool(date_from or date_to)
+    has_amount_range = amount_min is not None or amount_max is not None
+    if order_by is None:
+        order_by = "date" if has_date_range else "total_amount" if has_amount_range else "created_at"
+    if order_by not in config.RECORDS_SORT_FIELDS:
+        raise HTTPException(status_code=400, detail=f"order_byは{', '.join(config.RECORDS_SORT_FIELDS)}のいずれかを指定してください")
+    if has_date_range and order_by != "date":
+        raise HTTPException(status_code=400, detail="日付で絞り込む場合はdateで並び替えてください")
+    if has_amount_range and not has_date_range and order_by != "total_amount":
+        raise HTTPException(status_code=400, detail="金額で絞り込む場合はtotal_amountで並び替えてください")
+
+    limit = max(1, min(limit, config.RECORDS_PAGE_SIZE_MAX))
+    records_ref = db.collection(config.COL_USERS).document(u_id).collection("records")
+
+    # 1ページ目の読み込み開始時刻を差分同期の起点にする
+    watermark = None if cursor else datetime.now(timezone.utc)
+
+    # 絞り込み条件
+    query = records_ref
+    if category:
+        query = query.where("category", "==", category)
+    if date_from:
+        query = query.where("date", ">=", normalize_date(date_from))
+    if date_to:
+        query = query.where("date", "<=", normalize_date(date_to))
+    if amount_min is not None:
+        query = query.where("total_amount", ">=", amount_min)
+    if amount_max is not None:
+        query = query.where("total_amount", "<=", amount_max)
+    filtered_query = query
+
+    query = query.order_by(order_by, direction=firestore.Query.DESCENDING if direction == "desc" else firestore.Query.ASCENDING)
+
+    # 必要なフィールドのみ読み込む
+    if field_list:
+        query = query.select(field_list)
+
+    # カーソル（前ページ最後のレコードID）の次から取得
+    if cursor:
+        cursor_doc = records_ref.document(cursor).get()
+        if not cursor_doc.exists:
+            raise HTTPException(status_code=400, detail="無効なカーソルです")
+        query = query.start_after(cursor_doc)
+
+    # 1件多く取得して次ページの有無を判定
+    docs = list(query.limit(limit + 1).stream())
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+
+    records = []
+    for doc in docs:
+        records.append(public_record(doc.to_dict(), doc.id))
+
+    # 総件数は集計クエリで取得（1ページ目のみ）
+    total = None
+    if not cursor:
+        total = filtered_query.count(alias="total").get()[0][0].value
+
+    return {
+        "records": records,
+        "next_cursor": docs[-1].id if has_more and docs else None,
+        "has_more": has_more,
+        "total": total,
+        # 差分同期（/api/records/changes）の起点
+        "watermark": watermark.isoformat() if watermark else None
+    }
+
+@router.get("/api/records/recent")
+async def list_recent_records(u_id: str = Depends(get_current_user)):
+    """最新レコード一覧を取得（初期表示用。集計済みドキュメントから読み込むためクエリ不要）
+
+    続きは next_cursor を /api/records の cursor に渡して取得する。
+    """
+    # 読み込み開始時刻を差分同期の起点にする
+    watermark = datetime.now(timezone.utc)
+    recent = get_recent_records(u_id)
+    records = recent["records"]
+    has_more = recent["total"] > len(records)
+
+    return {
+        "records": records,
+        "next_cursor": records[-1]["id"] if has_more and records else None,
+        "has_more": has_more,
+        "total": recent["total"],
+        "watermark": watermark.isoformat()
+    }
+
+@router.get("/api/records/search")
+async def search_records(q: str, limit: int = config.RECORDS_PAGE_SIZE_DEFAULT, u_id: str = Depends(get_current_user)):
+    """店舗名でレコードを検索（全角半角・カタカナひらがなを区別しない部分一致）"""
+    limit = max(1, min(limit, config.RECORDS_PAGE_SIZE_MAX))
+    records = search_records_by_vendor(u_id, q, limit)
+    return {"records": records, "count": len(records)}
+
+@router.get("/api/records/changes")
+async def get_changes(since: str, limit: int = config.RECORDS_CHANGES_LIMIT, u_id: str = Depends(get_current_user)):
+    """指定時刻以降に追加・更新・削除されたレコードを取得（差分同期用）
+
+    full_resync が true の場合は削除記録が残っていないため、クライアントは一覧を取得し直す。
+    """
+    try:
+        since_dt = datetime.fromisoformat(since.replace("Z", "+00:00"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="sinceはISO 8601形式で指定してください")
+    if since_dt.tzinfo is None:
+        since_dt = since_dt.replace(tzinfo=timezone.utc)
+
+    limit = max(1, min(limit, config.RECORDS_CHANGES_LIMIT))
+    changes = get_record_changes(u_id, since_dt, limit)
+
+    return {
+        "upserts": changes["upserts"],
+        "deleted": changes["deleted"],
+        "watermark": changes["watermark"].isoformat() if changes["watermark"] else None,
+        "has_more": changes["has_more"],
+        "full_resync": changes["full_resync"]
+    }
+
 @router.post("/upload")
 async def upload_receipt(files: List[UploadFile] = File(...), u_id: str = Depends(get_current_user)):
     """複数ファイルのアップロード（サブコレクション対応）"""
@@ -28,101 +189,109 @@ async def upload_receipt(files: List[UploadFile] = File(...), u_id: str = Depend
     if not files or len(files) == 0:
         raise HTTPException(status_code=400, detail="ファイルが選択されていません")
 
-    # 使用上限チェック
-    if not check_usage_limit(u_id):
+    # 使用回数をファイル数分まとめて予約（残り回数を超える分は処理しない）
+    reservation = reserve_quota(u_id, len(files))
+    if reservation.granted == 0:
         raise HTTPException(
             status_code=403,
             detail="月間上限に達しました。プランをアップグレードしてください。"
         )
 
     all_results = []
+    consumed = 0
 
-    for idx, file in enumerate(files):
-        print(f"\n--- Processing file {idx + 1}/{len(files)}: {file.filename} ---")
-        try:
-            # ファイル名をサニタイズ
-            original_filename = file.filename
-            file_ext = os.path.splitext(original_filename)[1]
-            safe_filename = f"{int(time.time() * 1000)}{file_ext}"
-
-            print(f"Original filename: {original_filename}")
-            print(f"Safe filename: {safe_filename}")
-
-            # 1. 一時保存
-            temp_path = os.path.join(config.UPLOAD_DIR, safe_filename)
-            print(f"Saving to: {temp_path}")
-
-            with open(temp_path, "wb") as b:
-                shutil.copyfileobj(file.file, b)
-
-            # PDFファイルかどうかをチェック
-            is_pdf = original_filename.lower().endswith('.pdf')
-            print(f"Is PDF: {is_pdf}")
-
-            # 画像の場合は圧縮
-            if not is_pdf and file_ext.lower() in ['.jpg', '.jpeg', '.png', '.webp']:
-                print("Compressing image...")
-                temp_path = compress_image(temp_path, max_size=(1920, 1080), quality=85)
-
-            # 2. Cloud Storageへアップロード
-            gcs_file_name = f"receipts/{safe_filename}"
-            print(f"Uploading to GCS: {gcs_file_name}")
-            public_url = upload_to_gcs(temp_path, gcs_file_name)
-            print(f"GCS URL: {public_url}")
-
-            # 3. PDFの場合は画像化
-            pdf_image_urls = []
-            if is_pdf:
-                print("Converting PDF to images...")
-                pdf_image_urls = convert_pdf_to_images(temp_path)
-                print(f"PDF images created: {len(pdf_image_urls)}")
-
-            # 4. Gemini 解析（リトライ機能付き）
-            print("Starting Gemini analysis...")
-            data_list = analyze_with_gemini_retry(temp_path, max_retries=3)
-
-            # 5. サブコレクションに保存
-            print("Saving to Firestore subcollection...")
-            for item in (data_list if isinstance(data_list, list) else [data_list]):
-                doc_id = str(int(time.time()*1000))
-                time.sleep(0.001)
-                item.update({
-                    "image_url": public_url,
-                    "id": doc_id,
-                    "created_at": firestore.SERVER_TIMESTAMP,
-                    "is_pdf": is_pdf,
-                    "pdf_images": pdf_image_urls if is_pdf else [],
-                    "original_filename": original_filename,
-                    "category": "その他",
-                    "source": "web"
+    try:
+        for idx, file in enumerate(files[:reservation.granted]):
+            print(f"\n--- Processing file {idx + 1}/{len(files)}: {file.filename} ---")
+            try:
+                original_filename = file.filename
+                file_ext = os.path.splitext(original_filename)[1]
+                print(f"Original filename: {original_filename}")
+
+                # PDFファイルかどうかをチェック
+                is_pdf = original_filename.lower().endswith('.pdf')
+                print(f"Is PDF: {is_pdf}")
+
+                # 1. 一時保存（画像はアップロードストリームから直接圧縮して保存）
+                if not is_pdf and file_ext.lower() in ['.jpg', '.jpeg', '.png', '.webp']:
+                    print("Compressing image...")
+                    temp_path = compress_image(file.file, output_path=make_upload_path("web", ".jpg"), max_size=(1920, 1080), quality=85)
+                else:
+                    temp_path = make_upload_path("web", file_ext)
+                    with open(temp_path, "wb") as b:
+                        shutil.copyfileobj(file.file, b)
+                print(f"Saved to: {temp_path}")
+
+                # 2. Cloud Storageへアップロード
+                gcs_file_name = f"receipts/{os.path.basename(temp_path)}"
+                print(f"Uploading to GCS: {gcs_file_name}")
+                public_url = upload_to_gcs(temp_path, gcs_file_name)
+                print(f"GCS URL: {public_url}")
+
+                # 3. PDFの場合は画像化
+                pdf_image_urls = []
+                if is_pdf:
+                    print("Converting PDF to images...")
+                    pdf_image_urls = convert_pdf_to_images(temp_path)
+                    print(f"PDF images created: {len(pdf_image_urls)}")
+
+                # 4. Gemini 解析（リトライ機能付き）
+                print("Starting Gemini analysis...")
+                data_list = analyze_with_gemini_retry(temp_path, max_retries=3)
+
+                # 5. サブコレクションに保存（レコード・集計・最新一覧を1トランザクションで確定）
+                print("Saving to Firestore subcollection...")
+                saved_items = []
+                for item in (data_list if isinstance(data_list, list) else [data_list]):
+                    doc_id = str(int(time.time()*1000))
+                    time.sleep(0.001)
+                    normalize_record_fields(item)
+                    item.update({
+                        "image_url": public_url,
+                        "id": doc_id,
+                        "created_at": firestore.SERVER_TIMESTAMP,
+                        "updated_at": firestore.SERVER_TIMESTAMP,
+                        "is_pdf": is_pdf,
+                        "pdf_images": pdf_image_urls if is_pdf else [],
+                        "original_filename": original_filename,
+                        "category": "その他",
+                        "source": "web"
+                    })
+                    saved_items.append(item)
+
+                insert_records_transactional(u_id, saved_items)
+                consumed += 1
+
+                # 6. 一時ファイルを削除
+                os.remove(temp_path)
+
+                all_results.append({
+                    "filename": original_filename,
+                    "status": "success",
+                    "records_count": len(data_list) if isinstance(data_list, list) else 1
+                })
+                print(f"✅ Success: {original_filename}")
+
+            except Exception as e:
+                print(f"❌ Error processing {file.filename}: {type(e).__name__}: {str(e)}")
+                import traceback
+                traceback.print_exc()
+                all_results.append({
+                    "filename": str(file.filename),
+                    "status": "error",
+                    "error": str(e)
                 })
-                # サブコレクションに保存
-                db.collection(config.COL_USERS).document(u_id).collection("records").document(doc_id).set(item)
-
-            # 使用回数をインクリメント
-            db.collection(config.COL_USERS).document(u_id).update({
-                "subscription.used": firestore.Increment(1)
-            })
-
-            # 6. 一時ファイルを削除
-            os.remove(temp_path)
-
-            all_results.append({
-                "filename": original_filename,
-                "status": "success",
-                "records_count": len(data_list) if isinstance(data_list, list) else 1
-            })
-            print(f"✅ Success: {original_filename}")
 
-        except Exception as e:
-            print(f"❌ Error processing {file.filename}: {type(e).__name__}: {str(e)}")
-            import traceback
-            traceback.print_exc()
+        # 残り回数を超えたファイル
+        for file in files[reservation.granted:]:
             all_results.append({
                 "filename": str(file.filename),
                 "status": "error",
-                "error": str(e)
+                "error": "月間上限に達したため処理されませんでした"
             })
+    finally:
+        # 失敗したファイルの分を返却
+        reservation.commit(consumed)
 
     print(f"\n=== Upload complete ===")
     success_count = len([r for r in all_results if r['status'] == 'success'])
@@ -139,6 +308,21 @@ async def upload_receipt(files: List[UploadFile] = File(...), u_id: str = Depend
         }
     }
 
+def delete_record_images(record_data: dict):
+    """レコードに紐づく画像（PDF画像を含む）をGCSから削除"""
+    image_url = record_data.get("image_url", "")
+    if image_url:
+        delete_from_gcs(image_url)
+
+    if record_data.get("is_pdf") and record_data.get("pdf_images"):
+        for pdf_img_url in record_data["pdf_images"]:
+            delete_from_gcs(pdf_img_url)
+
+@router.get("/api/summary")
+async def get_records_summary(u_id: str = Depends(get_current_user)):
+    """月別・カテゴリ別の件数と合計金額を取得（集計ドキュメント1件の読み込み）"""
+    return get_summary(u_id)
+
 @router.put("/api/records/{record_id}")
 async def update_record(record_id: str, data: dict, u_id: str = Depends(get_current_user)):
     """レコードの情報を更新（サブコレクション対応）"""
@@ -146,36 +330,33 @@ async def update_record(record_id: str, data: dict, u_id: str = Depends(get_curr
         print(f"=== Update request for record: {record_id} ===")
         print(f"Update data: {data}")
 
-        # サブコレクションからレコードを取得
-        doc_ref = db.collection(config.COL_USERS).document(u_id).collection("records").document(record_id)
-        doc = doc_ref.get()
-
-        if not doc.exists:
-            raise HTTPException(status_code=404, detail="レコードが見つかりません")
-
         # 更新するフィールドを準備
         update_data = {}
 
         if "date" in data:
-            update_data["date"] = data["date"]
+            update_data["date"] = normalize_date(data["date"])
 
         if "vendor_name" in data:
             update_data["vendor_name"] = data["vendor_name"]
 
         if "total_amount" in data:
             try:
-                amount = int(str(data["total_amount"]).replace(",", "").replace("¥", "").strip())
-                update_data["total_amount"] = amount
+                update_data["total_amount"] = normalize_amount(data["total_amount"])
             except ValueError:
                 raise HTTPException(status_code=400, detail="金額は数値で指定してください")
 
         if "category" in data:
             update_data["category"] = data["category"]
 
-        # Firestoreを更新
+        # Firestoreを更新（集計ドキュメントと同一トランザクション）
         if update_data:
-            doc_ref.update(update_data)
-            print(f"✅ Updated record {record_id}: {update_data}")
+            updated = update_record_transactional(u_id, record_id, update_data)
+        else:
+            updated = db.collection(config.COL_USERS).document(u_id).collection("records").document(record_id).get().exists
+
+        if not updated:
+            raise HTTPException(status_code=404, detail="レコードが見つかりません")
+        print(f"✅ Updated record {record_id}: {update_data}")
 
         return {"message": "更新しました", "id": record_id, "updated_fields": update_data}
 
@@ -192,35 +373,19 @@ async def update_record(record_id: str, data: dict, u_id: str = Depends(get_curr
 async def delete_record(record_id: str, u_id: str = Depends(get_current_user)):
     """レコードを削除（サブコレクション対応）"""
     try:
-        # サブコレクションからレコード取得
-        doc_ref = db.collection(config.COL_USERS).document(u_id).collection("records").document(record_id)
-        doc = doc_ref.get()
+        # Firestoreからドキュメントを削除（削除記録・集計・使用カウントと同一トランザクション）
+        record_data = delete_record_transactional(u_id, record_id)
 
-        if not doc.exists:
+        if record_data is None:
             raise HTTPException(status_code=404, detail="レコードが見つかりません")
 
-        record_data = doc.to_dict()
-
         # GCSから画像ファイルを削除
-        image_url = record_data.get("image_url", "")
-        if image_url:
-            delete_from_gcs(image_url)
-
-        # PDF画像も削除
-        if record_data.get("is_pdf") and record_data.get("pdf_images"):
-            for pdf_img_url in record_data["pdf_images"]:
-                delete_from_gcs(pdf_img_url)
-
-        # Firestoreからドキュメントを削除
-        doc_ref.delete()
-
-        # 使用カウントを減らす
-        db.collection(config.COL_USERS).document(u_id).update({
-            "subscription.used": firestore.Increment(-1)
-        })
+        delete_record_images(record_data)
 
         return {"message": "削除しました", "id": record_id}
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"削除に失敗しました: {str(e)}")
 
@@ -237,24 +402,12 @@ async def bulk_delete_records(data: dict, u_id: str = Depends(get_current_user))
 
     for record_id in record_ids:
         try:
-            # サブコレクションから削除
-            doc_ref = db.collection(config.COL_USERS).document(u_id).collection("records").document(record_id)
-            doc = doc_ref.get()
-
-            if doc.exists:
-                record_data = doc.to_dict()
+            # サブコレクションから削除（使用カウントは最後にまとめて減らす）
+            record_data = delete_record_transactional(u_id, record_id, decrement_usage=False)
 
+            if record_data is not None:
                 # GCSから画像削除
-                image_url = record_data.get("image_url", "")
-                if image_url:
-                    delete_from_gcs(image_url)
-
-                # PDF画像も削除
-                if record_data.get("is_pdf") and record_data.get("pdf_images"):
-                    for pdf_img_url in record_data["pdf_images"]:
-                        delete_from_gcs(pdf_img_url)
-
-                doc_ref.delete()
+                delete_record_images(record_data)
                 deleted_count += 1
         except Exception as e:
             print(f"Error deleting {record_id}: {e}")
@@ -262,9 +415,7 @@ async def bulk_delete_records(data: dict, u_id: str = Depends(get_current_user))
 
     # 使用カウントを減らす
     if deleted_count > 0:
-        db.collection(config.COL_USERS).document(u_id).update({
-            "subscription.used": firestore.Increment(-deleted_count)
-        })
+        increment_usage(u_id, -deleted_count)
 
     return {
         "message": f"{deleted_count}件のレコードを削除しました",
@@ -299,18 +450,14 @@ async def bulk_update_records(data: dict, u_id: str = Depends(get_current_user))
         update_data["category"] = update_fields["category"]
 
     if "date" in update_fields and update_fields["date"]:
-        update_data["date"] = update_fields["date"]
+        update_data["date"] = normalize_date(update_fields["date"])
 
     if not update_data:
         raise HTTPException(status_code=400, detail="有効な更新フィールドがありません")
 
     for record_id in record_ids:
         try:
-            doc_ref = db.collection(config.COL_USERS).document(u_id).collection("records").document(record_id)
-            doc = doc_ref.get()
-
-            if doc.exists:
-                doc_ref.update(update_data)
+            if update_record_transactional(u_id, record_id, update_data):
                 updated_count += 1
                 print(f"[OK] Updated record {record_id}")
             else:
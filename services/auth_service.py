@@ -2,9 +2,13 @@
 認証サービス
 JWT生成・検証、パスワード処理
 """
+import asyncio
+import threading
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from jose import JWTError, jwt
-from fastapi import HTTPException, Request
+from fastapi import Depends, HTTPException, Request
 from database import pwd_context
 import config
 
@@ -15,41 +19,120 @@ def create_access_token(data: dict) -> str:
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, config.SECRET_KEY, algorithm=config.ALGORITHM)
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    """パスワードを検証"""
+def create_user_tokens(user_id: str, user_data: dict) -> dict:
+    """ロール・プラン・トークンバージョンのクレーム付きアクセストークンとリフレッシュトークンを発行"""
+    version = user_data.get("token_version", 0)
+    access_token = create_access_token({
+        "sub": user_id,
+        "role": user_data.get("role", "user"),
+        "plan": user_data.get("subscription", {}).get("plan", "free"),
+        "ver": version,
+        "typ": "access"
+    })
+    refresh_token = jwt.encode({
+        "sub": user_id,
+        "typ": "refresh",
+        "exp": datetime.utcnow() + timedelta(days=config.REFRESH_TOKEN_EXPIRE_DAYS)
+    }, config.SECRET_KEY, algorithm=config.ALGORITHM)
+    return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer"}
+
+def decode_refresh_token(token: str) -> dict:
+    """リフレッシュトークンを検証してクレームを返す"""
     try:
-        return pwd_context.verify(plain_password, hashed_password)
+        payload = jwt.decode(token, config.SECRET_KEY, algorithms=[config.ALGORITHM])
+    except JWTError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if payload.get("typ") != "refresh":
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return payload
+
+def _is_revoked(payload: dict) -> bool:
+    """ユーザーが削除済み、またはトークンの ver が保存済みの token_version より古いか
+
+    ユーザードキュメントはキャッシュから読む（更新は無効化バスで全インスタンスに反映される）。
+    """
+    # user_service が get_current_user を使うため、ここで読み込む（循環import回避）
+    from services.user_service import get_user_doc
+    user_data = get_user_doc(payload.get("sub"))
+    if user_data is None:
+        return True
+    return payload.get("ver", 0) < (user_data.get("token_version") or 0)
+
+# パスワードハッシュ計算専用のスレッドプール（イベントループと他の処理を塞がない）
+_password_executor = ThreadPoolExecutor(max_workers=config.PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+_pending_lock = threading.Lock()
+_pending = 0
+
+async def _run_password_task(func, *args):
+    """ハッシュ計算を専用スレッドプールで実行（待ち行列が上限を超えたら503）"""
+    global _pending
+    with _pending_lock:
+        if _pending >= config.PASSWORD_HASH_MAX_PENDING:
+            raise HTTPException(status_code=503, detail="混み合っています。しばらくしてから再度お試しください")
+        _pending += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_password_executor, func, *args)
+    finally:
+        with _pending_lock:
+            _pending -= 1
+
+def _verify_and_update(plain_password: str, hashed_password: str) -> tuple:
+    try:
+        return pwd_context.verify_and_update(plain_password, hashed_password)
     except ValueError as e:
-        # パスワード検証エラーが発生した場合はFalseを返す
         print(f"[WARNING] Password verification error: {str(e)}")
-        return False
-    except Exception as e:
-        # その他のエラーもキャッチ
-        print(f"[ERROR] Unexpected error during password verification: {str(e)}")
-        return False
+        return False, None
 
-def hash_password(password: str) -> str:
-    """パスワードをハッシュ化"""
-    return pwd_context.hash(password)
+async def verify_password_async(plain_password: str, hashed_password: str) -> tuple:
+    """パスワードを検証（専用スレッドで実行）
 
-async def get_current_user(request: Request) -> str:
-    """現在のユーザーIDをトークンから取得"""
-    token = request.headers.get("Authorization")
-    if not token or not token.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Unauthorized")
+    (検証結果, 新しいハッシュ) を返す。反復回数が古い場合のみ新しいハッシュが入る。
+    """
+    return await _run_password_task(_verify_and_update, plain_password, hashed_password)
+
+async def hash_password_async(password: str) -> str:
+    """パスワードをハッシュ化（専用スレッドで実行）"""
+    return await _run_password_task(pwd_context.hash, password)
+
+def decode_access_token(token: str) -> dict:
+    """アクセストークンを検証してクレームを返す（署名・種別・失効を確認）
+
+    トークンを受け取る経路はすべてこの関数で検証すること。
+    """
     try:
-        payload = jwt.decode(token.split(" ")[1], config.SECRET_KEY, algorithms=[config.ALGORITHM])
-        return payload.get("sub")
+        payload = jwt.decode(token, config.SECRET_KEY, algorithms=[config.ALGORITHM])
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    if payload.get("typ") != "access" or not payload.get("sub"):
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if _is_revoked(payload):
+        raise HTTPException(status_code=401, detail="Token revoked")
+    return payload
 
-async def get_current_user_optional(request: Request):
-    """オプショナルな認証（トークンがない場合はNoneを返す）"""
-    token = request.headers.get("Authorization")
-    if not token or not token.startswith("Bearer "):
-        return None
-    try:
-        payload = jwt.decode(token.split(" ")[1], config.SECRET_KEY, algorithms=[config.ALGORITHM])
-        return payload.get("sub")
-    except JWTError:
-        return None
+def _bearer_token(request: Request) -> Optional[str]:
+    auth_header = request.headers.get("Authorization")
+    if auth_header and auth_header.startswith("Bearer "):
+        return auth_header.split(" ")[1]
+    return None
+
+async def get_token_claims(request: Request) -> dict:
+    """Authorizationヘッダーのアクセストークンのクレームを取得"""
+    token = _bearer_token(request)
+    if not token:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    return decode_access_token(token)
+
+async def get_current_user(claims: dict = Depends(get_token_claims)) -> str:
+    """現在のユーザーIDをトークンから取得"""
+    return claims.get("sub")
+
+async def get_current_user_from_query(request: Request, token: Optional[str] = None) -> str:
+    """クエリパラメータ token（なければAuthorizationヘッダー）から現在のユーザーIDを取得
+
+    EventSource・ダウンロード用のURLはヘッダーを付けられないため。
+    """
+    token = token or _bearer_token(request)
+    if not token:
+        raise HTTPException(status_code=401, detail="認証が必要です")
+    return decode_access_token(token)["sub"]
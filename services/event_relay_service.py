@@ -0,0 +1,102 @@
+"""
+イベント中継サービス
+他のインスタンス（LINE Webhookなど）で確定したレコード・使用回数の変更をFirestoreのスナップショットリスナーで受け取り、
+このインスタンスのSSE購読者へ配信する
+
+リスナーはこのインスタンスに接続中のユーザーごとに1組（レコード・削除記録・ユーザードキュメント）だけ作り、
+最後の接続が切れたら停止する。
+"""
+import threading
+from datetime import datetime, timedelta, timezone
+from database import db
+from services.event_service import event_broker
+from services.record_service import records_collection, tombstones_collection, compact_record, public_record
+import config
+
+_watches = {}
+_lock = threading.Lock()
+
+class _UserWatch:
+    """1ユーザー分のリスナー"""
+
+    def __init__(self, u_id: str):
+        self.u_id = u_id
+        self.count = 0
+        self.last_subscription = None
+        self.listeners = []
+
+    def start(self):
+        since = datetime.now(timezone.utc) - timedelta(seconds=config.SSE_RELAY_CLOCK_SKEW_SECONDS)
+        self.listeners = [
+            records_collection(self.u_id).where("updated_at", ">=", since).on_snapshot(self._on_records),
+            tombstones_collection(self.u_id).where("updated_at", ">=", since).on_snapshot(self._on_tombstones),
+            db.collection(config.COL_USERS).document(self.u_id).on_snapshot(self._on_user),
+        ]
+
+    def stop(self):
+        for listener in self.listeners:
+            try:
+                listener.unsubscribe()
+            except Exception as e:
+                print(f"[WARNING] Event relay unsubscribe failed ({self.u_id}): {str(e)}")
+        self.listeners = []
+
+    def _on_records(self, snapshots, changes, read_time):
+        for change in changes:
+            if change.type.name == "REMOVED":
+                continue
+            data = change.document.to_dict() or {}
+            record = compact_record(public_record(data, change.document.id))
+            # 追加時は created_at と updated_at が同じ時刻（同じ書き込みのサーバー時刻）になる
+            event_type = "record_created" if data.get("created_at") == data.get("updated_at") else "record_updated"
+            event_broker.publish(self.u_id, event_type, record, relayed=True)
+
+    def _on_tombstones(self, snapshots, changes, read_time):
+        for change in changes:
+            if change.type.name != "REMOVED":
+                event_broker.publish(self.u_id, "record_deleted", {"id": change.document.id}, relayed=True)
+
+    def _on_user(self, snapshots, changes, read_time):
+        for snapshot in snapshots:
+            subscription = (snapshot.to_dict() or {}).get("subscription", {}) if snapshot.exists else {}
+            current = (subscription.get("plan"), subscription.get("limit"), subscription.get("used"))
+            # 最初のスナップショットは基準値として記録するだけ
+            if self.last_subscription is not None and current != self.last_subscription:
+                event_broker.publish(self.u_id, "quota_changed", {"plan": current[0], "limit": current[1]}, relayed=True)
+            self.last_subscription = current
+
+def watch_user(u_id: str):
+    """ユーザーの変更の中継を開始（SSE接続ごとに呼び出す）"""
+    if not config.SSE_RELAY_ENABLED:
+        return
+    with _lock:
+        watch = _watches.get(u_id)
+        if watch is None:
+            watch = _UserWatch(u_id)
+            _watches[u_id] = watch
+        watch.count += 1
+        if watch.count > 1:
+            return
+    try:
+        watch.start()
+    except Exception as e:
+        print(f"[WARNING] Event relay start failed ({u_id}): {str(e)}")
+
+def unwatch_user(u_id: str):
+    """ユーザーの変更の中継を終了（最後の接続が切れたらリスナーを停止）"""
+    if not config.SSE_RELAY_ENABLED:
+        return
+    with _lock:
+        watch = _watches.get(u_id)
+        if watch is None:
+            return
+        watch.count -= 1
+        if watch.count > 0:
+            return
+        del _watches[u_id]
+    watch.stop()
+
+def get_relay_stats() -> dict:
+    """中継中のユーザー数"""
+    with _lock:
+        return {"watched_users": len(_watches)}
@@ -0,0 +1,89 @@
+"""
+イベント配信サービス
+レコードの追加・更新・削除や使用回数の変化をユーザーごとの購読者（SSE接続）へ配信
+"""
+import json
+import asyncio
+import threading
+from utils.ttl_cache import TTLCache
+import config
+
+class EventBroker:
+    """プロセス内のユーザー別イベント配信
+
+    購読はイベントループ上で行い、配信はワーカースレッド（LINE処理など）からも呼び出せる。
+    """
+
+    def __init__(self, queue_size: int, dedup_seconds: float):
+        self.queue_size = queue_size
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        # このインスタンスで配信済みのレコードのイベント（中継で同じ変更が届いたら配信しない）
+        self._local_events = TTLCache(dedup_seconds)
+
+    def subscribe(self, u_id: str) -> asyncio.Queue:
+        """購読を開始（イベントループ上で呼び出す）"""
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._subscribers.setdefault(u_id, []).append((loop, queue))
+        return queue
+
+    def unsubscribe(self, u_id: str, queue: asyncio.Queue):
+        """購読を終了"""
+        with self._lock:
+            subscribers = [s for s in self._subscribers.get(u_id, []) if s[1] is not queue]
+            if subscribers:
+                self._subscribers[u_id] = subscribers
+            else:
+                self._subscribers.pop(u_id, None)
+
+    def publish(self, u_id: str, event_type: str, data: dict = None, relayed: bool = False):
+        """ユーザーの全購読者へイベントを配信（購読者がいなければ何もしない）
+
+        relayed=True は他インスタンスの変更をリスナー経由で受け取ったもの。
+        このインスタンスで配信済みのレコードのイベントは重複して送らない。
+        """
+        with self._lock:
+            subscribers = list(self._subscribers.get(u_id, []))
+        if not subscribers:
+            return
+
+        record_id = (data or {}).get("id")
+        if record_id:
+            key = (u_id, event_type, record_id)
+            if relayed and self._local_events.get(key):
+                return
+            if not relayed:
+                self._local_events.set(key, True)
+
+        event = {"type": event_type, "data": data or {}}
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(self._enqueue, queue, event)
+            except RuntimeError:
+                # イベントループが終了している
+                self.unsubscribe(u_id, queue)
+
+    @staticmethod
+    def _enqueue(queue: asyncio.Queue, event: dict):
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # 読み出しが追いつかない購読者には全件再同期を促す
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait({"type": "resync", "data": {}})
+
+    def subscriber_count(self) -> int:
+        """現在の購読数"""
+        with self._lock:
+            return sum(len(s) for s in self._subscribers.values())
+
+def format_sse(event: dict) -> str:
+    """イベントをSSE形式の文字列に変換"""
+    payload = json.dumps(event["data"], ensure_ascii=False, default=str)
+    return f"event: {event['type']}\ndata: {payload}\n\n"
+
+# アプリ全体で共有するブローカー
+event_broker = EventBroker(config.SSE_QUEUE_SIZE, config.SSE_RELAY_DEDUP_SECONDS)
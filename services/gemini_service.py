@@ -4,6 +4,7 @@ Gemini AI サービス
 """
 import time
 import json
+import threading
 import google.generativeai as genai
 import config
 
@@ -11,22 +12,26 @@ import config
 genai.configure(api_key=config.GEMINI_API_KEY)
 model = genai.GenerativeModel('gemini-2.5-pro')
 
+# プロセス全体の同時解析数を制限（Web/LINEの全経路で共有）
+_gemini_limiter = threading.BoundedSemaphore(config.GEMINI_MAX_CONCURRENCY)
+
 def analyze_with_gemini_retry(file_path: str, max_retries: int = 3) -> dict:
     """Gemini APIを使用して画像を解析（リトライ機能付き）"""
     for attempt in range(max_retries):
         try:
             print(f"Gemini API attempt {attempt + 1}/{max_retries}...")
 
-            # ファイルをアップロード
-            genai_file = genai.upload_file(path=file_path)
+            with _gemini_limiter:
+                # ファイルをアップロード
+                genai_file = genai.upload_file(path=file_path)
 
-            # 処理待ち
-            while genai_file.state.name == "PROCESSING":
-                time.sleep(1)
-                genai_file = genai.get_file(genai_file.name)
+                # 処理待ち
+                while genai_file.state.name == "PROCESSING":
+                    time.sleep(1)
+                    genai_file = genai.get_file(genai_file.name)
 
-            # 解析実行
-            response = model.generate_content([genai_file, config.GEMINI_PROMPT])
+                # 解析実行
+                response = model.generate_content([genai_file, config.GEMINI_PROMPT])
 
             if not response.text:
                 raise ValueError("Gemini APIからの応答が空です")
@@ -46,3 +51,70 @@ def analyze_with_gemini_retry(file_path: str, max_retries: int = 3) -> dict:
                 time.sleep(wait_time)
             else:
                 raise Exception(f"Gemini API解析に失敗しました（{max_retries}回試行）: {str(e)}")
+
+def _as_record_list(data) -> list:
+    """1枚分の解析結果をレコード（dict）のリストにそろえる"""
+    if isinstance(data, dict):
+        return [data]
+    if isinstance(data, list):
+        return [item for item in data if isinstance(item, dict)]
+    return []
+
+def analyze_batch_with_gemini_retry(file_paths: list, max_retries: int = 3) -> list:
+    """複数画像を1回のリクエストでまとめて解析（画像ごとのレコードのリストを返す）
+
+    一括解析に失敗した場合は画像ごとの解析に切り替える。
+    個別解析にも失敗した画像の結果はNoneになる。
+    """
+    if len(file_paths) == 1:
+        try:
+            return [_as_record_list(analyze_with_gemini_retry(file_paths[0], max_retries=max_retries))]
+        except Exception as e:
+            print(f"❌ Gemini analysis failed: {str(e)}")
+            return [None]
+
+    prompt = config.GEMINI_BATCH_PROMPT.replace("{count}", str(len(file_paths)))
+
+    for attempt in range(max_retries):
+        try:
+            print(f"Gemini batch attempt {attempt + 1}/{max_retries} ({len(file_paths)} images)...")
+
+            with _gemini_limiter:
+                genai_files = [genai.upload_file(path=path) for path in file_paths]
+
+                for i, genai_file in enumerate(genai_files):
+                    while genai_file.state.name == "PROCESSING":
+                        time.sleep(1)
+                        genai_file = genai.get_file(genai_file.name)
+                    genai_files[i] = genai_file
+
+                response = model.generate_content([*genai_files, prompt])
+
+            if not response.text:
+                raise ValueError("Gemini APIからの応答が空です")
+
+            results = json.loads(response.text.strip().replace('```json', '').replace('```', ''))
+
+            if not isinstance(results, list) or len(results) != len(file_paths):
+                raise ValueError(f"画像枚数と結果の件数が一致しません: {len(file_paths)} != {len(results) if isinstance(results, list) else 1}")
+
+            print(f"✅ Gemini batch analysis successful")
+            return [_as_record_list(r) for r in results]
+
+        except Exception as e:
+            print(f"❌ Gemini batch error (attempt {attempt + 1}): {str(e)}")
+            if attempt < max_retries - 1:
+                wait_time = 2 ** attempt
+                print(f"Retrying in {wait_time} seconds...")
+                time.sleep(wait_time)
+
+    # 一括解析に失敗した場合は1枚ずつ解析
+    print("Falling back to per-image analysis...")
+    results = []
+    for path in file_paths:
+        try:
+            results.append(_as_record_list(analyze_with_gemini_retry(path, max_retries=max_retries)))
+        except Exception as e:
+            print(f"❌ Gemini analysis failed for {path}: {str(e)}")
+            results.append(None)
+    return results
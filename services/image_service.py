@@ -4,6 +4,7 @@
 """
 import os
 import time
+import shutil
 from PIL import Image, ImageOps
 from services.storage_service import upload_to_gcs
 import config
@@ -16,13 +17,26 @@ except ImportError:
     PDF_SUPPORT = False
     print("警告: pdf2imageがインストールされていません。PDF画像化機能は無効です。")
 
-def compress_image(input_path: str, output_path: str = None, max_size: tuple = (1920, 1080), quality: int = 85) -> str:
-    """画像を圧縮してファイルサイズを削減"""
+def compress_image(input_path, output_path: str = None, max_size: tuple = (1920, 1080), quality: int = 85) -> str:
+    """画像を圧縮してファイルサイズを削減
+
+    input_pathにはファイルパスのほか、バイナリのファイルオブジェクト
+    （アップロードやダウンロードのストリーム）も指定できる。
+    ファイルオブジェクトの場合はoutput_pathが必須。
+    """
+    is_stream = not isinstance(input_path, (str, os.PathLike))
     if output_path is None:
+        if is_stream:
+            raise ValueError("ストリーム入力の場合は出力先パスが必要です")
         output_path = input_path
 
+    source_name = getattr(input_path, "name", "stream") if is_stream else input_path
+
     try:
         with Image.open(input_path) as img:
+            # JPEGは縮小デコードしてメモリ使用量を抑える
+            img.draft("RGB", max_size)
+
             # EXIF情報に基づいて画像を回転
             try:
                 img = ImageOps.exif_transpose(img)
@@ -45,10 +59,16 @@ def compress_image(input_path: str, output_path: str = None, max_size: tuple = (
             # 保存
             img.save(output_path, 'JPEG', optimize=True, quality=quality)
 
-            print(f"✅ Image compressed: {input_path} -> {output_path}")
+            print(f"✅ Image compressed: {source_name} -> {output_path}")
             return output_path
     except Exception as e:
         print(f"⚠️ Image compression failed: {str(e)}, using original")
+        if is_stream:
+            # 圧縮できない場合は元データをそのまま保存
+            input_path.seek(0)
+            with open(output_path, "wb") as f:
+                shutil.copyfileobj(input_path, f)
+            return output_path
         return input_path
 
 def convert_pdf_to_images(pdf_path: str) -> list:
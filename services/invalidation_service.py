@@ -0,0 +1,112 @@
+"""
+キャッシュ無効化バス
+Cloud Run の複数インスタンス間でプロセス内キャッシュの無効化を共有する
+
+更新したインスタンスが変更ログ（cache_invalidations）に1件書き込み、
+各インスタンスはスナップショットリスナーで受け取って登録済みのハンドラでキャッシュを破棄する。
+自分が書き込んだ無効化は受け取っても無視する（自分のキャッシュは書き込み時に反映済み）。
+
+変更ログは expire_at のTTLポリシーで自動削除する:
+    gcloud firestore fields ttls update expire_at --collection-group=cache_invalidations --enable-ttl
+"""
+import uuid
+import threading
+from datetime import datetime, timedelta, timezone
+from google.cloud import firestore
+from database import db
+import config
+
+# このプロセスの識別子（自分の書き込みを受信時に除外する）
+INSTANCE_ID = uuid.uuid4().hex
+
+_handlers = {}
+_listener = None
+_listener_lock = threading.Lock()
+
+_stats_lock = threading.Lock()
+_stats = {
+    "published": 0,
+    "publish_errors": 0,
+    "received": 0,
+    "applied": 0
+}
+
+def _count(key: str, n: int = 1):
+    with _stats_lock:
+        _stats[key] += n
+
+def register_handler(scope: str, handler):
+    """無効化を受け取ったときの処理を登録（handler(key, value)）"""
+    _handlers[scope] = handler
+
+def publish_invalidation(scope: str, key: str, value=None):
+    """他インスタンスにキャッシュの無効化を通知
+
+    書き込みに失敗しても元の処理は止めない（各キャッシュのTTLで最終的に反映される）。
+    """
+    if not config.CACHE_BUS_ENABLED:
+        return
+    try:
+        db.collection(config.COL_CACHE_INVALIDATIONS).add({
+            "scope": scope,
+            "key": key,
+            "value": value,
+            "origin": INSTANCE_ID,
+            "created_at": firestore.SERVER_TIMESTAMP,
+            "expire_at": datetime.now(timezone.utc) + timedelta(seconds=config.CACHE_BUS_RETENTION_SECONDS)
+        })
+        _count("published")
+    except Exception as e:
+        _count("publish_errors")
+        print(f"[WARNING] Cache invalidation publish failed ({scope}:{key}): {str(e)}")
+
+def _on_snapshot(snapshots, changes, read_time):
+    """変更ログの追加を受け取り、他インスタンスの無効化をハンドラに渡す"""
+    for change in changes:
+        if change.type.name != "ADDED":
+            continue
+        data = change.document.to_dict() or {}
+        if data.get("origin") == INSTANCE_ID:
+            continue
+        _count("received")
+        handler = _handlers.get(data.get("scope"))
+        if handler is None:
+            continue
+        try:
+            handler(data.get("key"), data.get("value"))
+            _count("applied")
+        except Exception as e:
+            print(f"[WARNING] Cache invalidation handler failed ({data.get('scope')}:{data.get('key')}): {str(e)}")
+
+def start_invalidation_listener():
+    """変更ログの監視を開始（起動時に1回）
+
+    起動前の変更ログは不要なので、時計のずれを見込んで少し前からの分だけを監視する。
+    """
+    global _listener
+    if not config.CACHE_BUS_ENABLED:
+        return
+    with _listener_lock:
+        if _listener is not None:
+            return
+        since = datetime.now(timezone.utc) - timedelta(seconds=config.CACHE_BUS_CLOCK_SKEW_SECONDS)
+        query = db.collection(config.COL_CACHE_INVALIDATIONS).where("created_at", ">=", since)
+        _listener = query.on_snapshot(_on_snapshot)
+    print(f"[OK] Cache invalidation listener started (instance: {INSTANCE_ID[:8]})")
+
+def stop_invalidation_listener():
+    """変更ログの監視を停止"""
+    global _listener
+    with _listener_lock:
+        if _listener is None:
+            return
+        _listener.unsubscribe()
+        _listener = None
+
+def get_invalidation_stats() -> dict:
+    """無効化の送信・受信数を取得"""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["instance_id"] = INSTANCE_ID
+    stats["listening"] = _listener is not None
+    return stats
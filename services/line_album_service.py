@@ -0,0 +1,65 @@
+"""
+LINEアルバム集約サービス
+短時間に連続して届いた画像をLINEユーザー単位で1つのバッチにまとめる
+"""
+import threading
+import config
+
+class _PendingAlbum:
+    """集約中のアルバム"""
+
+    def __init__(self):
+        self.events = []
+        self.expected = None
+        self.ready = threading.Event()
+
+class AlbumAggregator:
+    """LINEユーザーごとに画像イベントを集約
+
+    最初に画像を受け取ったスレッド（リーダー）が集約期間だけ待機し、
+    その間に届いた画像をまとめて受け取る。後続のスレッドは即座に戻る。
+    """
+
+    def __init__(self, window_seconds: float, max_images: int):
+        self.window_seconds = window_seconds
+        self.max_images = max_images
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key: str, events: list):
+        """画像イベントを追加（リーダーなら集約済みイベント一覧、それ以外はNoneを返す）"""
+        with self._lock:
+            album = self._pending.get(key)
+            is_leader = album is None
+            if is_leader:
+                album = _PendingAlbum()
+                self._pending[key] = album
+
+            album.events.extend(events)
+
+            # 画像セット（アルバム送信）の枚数が分かれば揃った時点で締め切る
+            for event in events:
+                image_set = getattr(event.message, "image_set", None)
+                total = getattr(image_set, "total", None)
+                if total:
+                    album.expected = max(album.expected or 0, total)
+
+            limit = min(album.expected or self.max_images, self.max_images)
+            if len(album.events) >= limit:
+                album.ready.set()
+                # 上限に達したら次の画像からは新しいバッチにする
+                if self._pending.get(key) is album:
+                    del self._pending[key]
+
+        if not is_leader:
+            return None
+
+        album.ready.wait(self.window_seconds)
+
+        with self._lock:
+            if self._pending.get(key) is album:
+                del self._pending[key]
+            return list(album.events)
+
+# アプリ全体で共有するアグリゲーター
+album_aggregator = AlbumAggregator(config.LINE_ALBUM_WINDOW_SECONDS, config.LINE_ALBUM_MAX_IMAGES)
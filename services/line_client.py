@@ -0,0 +1,156 @@
+"""
+LINE Messaging API クライアント
+コネクションプール付きの非同期HTTPクライアントで返信・プッシュ・コンテンツ取得を行う
+"""
+import uuid
+import asyncio
+import tempfile
+import httpx
+import config
+
+LINE_API_BASE = "https://api.line.me/v2/bot"
+LINE_DATA_API_BASE = "https://api-data.line.me/v2/bot"
+
+# リクエストを送信する前に失敗したことが確実な通信エラー（再送しても二重処理にならない）
+_NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+class LineApiError(Exception):
+    """LINE Messaging API のエラー"""
+
+    def __init__(self, status_code, message: str, retry_after: float = None):
+        super().__init__(f"LINE API error ({status_code}): {message}")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        """再試行で回復が見込めるか（通信エラー・429・5xx）"""
+        return self.status_code is None or self.status_code == 429 or self.status_code >= 500
+
+class LineMessagingClient:
+    """LINE Messaging API の非同期クライアント（アプリ全体で1つのコネクションプールを共有）"""
+
+    def __init__(self, access_token: str):
+        self.access_token = access_token
+        self._client = None
+        self._loop = None
+
+    async def start(self):
+        """クライアントを初期化（起動時にイベントループ上で呼び出す）"""
+        if self._client is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._client = httpx.AsyncClient(
+            headers={"Authorization": f"Bearer {self.access_token}"},
+            limits=httpx.Limits(
+                max_connections=config.LINE_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=config.LINE_HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=config.LINE_HTTP_KEEPALIVE_SECONDS
+            ),
+            timeout=httpx.Timeout(config.LINE_HTTP_TIMEOUT_SECONDS, connect=config.LINE_HTTP_CONNECT_TIMEOUT_SECONDS)
+        )
+        print("[OK] LINE HTTP client started")
+
+    async def close(self):
+        """クライアントを終了（シャットダウン時）"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _raise_for_status(self, response: httpx.Response):
+        if response.status_code < 400:
+            return
+        retry_after = response.headers.get("Retry-After")
+        raise LineApiError(
+            response.status_code,
+            response.text[:200],
+            retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None
+        )
+
+    async def _with_retry(self, operation, description: str, idempotent: bool = True):
+        """通信エラー・429・5xxを指数バックオフで再試行
+
+        idempotent=False の場合は、送信前の接続エラーと429（未処理）のみ再試行する。
+        """
+        max_retries = config.LINE_HTTP_MAX_RETRIES
+        for attempt in range(max_retries + 1):
+            try:
+                return await operation()
+            except httpx.TransportError as e:
+                error = LineApiError(None, f"{type(e).__name__}: {str(e)}")
+                if not idempotent and not isinstance(e, _NOT_SENT_ERRORS):
+                    raise error from e
+            except LineApiError as e:
+                if not e.retryable or (not idempotent and e.status_code != 429):
+                    raise
+                error = e
+
+            if attempt >= max_retries:
+                raise error
+
+            wait_time = error.retry_after or config.LINE_HTTP_BACKOFF_SECONDS * (2 ** attempt)
+            print(f"[LINE] {description} failed ({error}), retrying in {wait_time}s...")
+            await asyncio.sleep(wait_time)
+
+    async def reply_text(self, reply_token: str, text: str):
+        """リプライトークンでテキストを返信
+
+        リプライトークンは1回しか使えず、送信済みかもしれないリクエストを再送すると
+        二重返信や無効なトークンのエラーになるため、送信前の失敗のみ再試行する。
+        失敗時は LineApiError を送出する（呼び出し側でプッシュ送信に切り替える）。
+        """
+        async def operation():
+            response = await self._client.post(f"{LINE_API_BASE}/message/reply", json={
+                "replyToken": reply_token,
+                "messages": [{"type": "text", "text": text}]
+            })
+            self._raise_for_status(response)
+
+        await self._with_retry(operation, "reply", idempotent=False)
+
+    async def push_text(self, to: str, text: str):
+        """テキストをプッシュ送信"""
+        # 再試行しても二重送信にならないようリトライキーを固定
+        headers = {"X-Line-Retry-Key": str(uuid.uuid4())}
+
+        async def operation():
+            response = await self._client.post(f"{LINE_API_BASE}/message/push", headers=headers, json={
+                "to": to,
+                "messages": [{"type": "text", "text": text}]
+            })
+            if response.status_code == 409:
+                # 同じリトライキーで送信済み
+                return
+            self._raise_for_status(response)
+
+        await self._with_retry(operation, "push")
+
+    async def download_content(self, message_id: str) -> tempfile.SpooledTemporaryFile:
+        """メッセージのコンテンツをストリーミングで取得（一定サイズを超えるとディスクへ退避）"""
+        async def operation():
+            spool = tempfile.SpooledTemporaryFile(max_size=config.SPOOL_MAX_MEMORY_BYTES)
+            try:
+                async with self._client.stream("GET", f"{LINE_DATA_API_BASE}/message/{message_id}/content") as response:
+                    if response.status_code >= 400:
+                        await response.aread()
+                        self._raise_for_status(response)
+                    async for chunk in response.aiter_bytes(config.DOWNLOAD_CHUNK_SIZE):
+                        spool.write(chunk)
+            except BaseException:
+                spool.close()
+                raise
+            spool.seek(0)
+            return spool
+
+        return await self._with_retry(operation, f"content download {message_id}")
+
+    def run(self, coro, timeout: float = None):
+        """ワーカースレッドから呼び出し、イベントループ上で実行して結果を待つ"""
+        if self._loop is None:
+            coro.close()
+            raise RuntimeError("LINE HTTP client is not started")
+        future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+        return future.result(timeout or config.LINE_HTTP_CALL_TIMEOUT_SECONDS)
+
+# アプリ全体で共有するクライアント
+line_client = LineMessagingClient(config.LINE_CHANNEL_ACCESS_TOKEN)
@@ -0,0 +1,136 @@
+"""
+LINEイベント重複排除サービス
+Webhookの再送による二重解析・二重登録を防止
+"""
+import threading
+from datetime import datetime, timedelta, timezone
+from google.api_core.exceptions import AlreadyExists
+from google.cloud import firestore
+from database import db
+from utils.ttl_cache import TTLCache
+import config
+
+# プロセス内の処理済みキー（Firestoreへの問い合わせを省略するための一次キャッシュ）
+_seen = TTLCache(config.LINE_EVENT_DEDUP_TTL_SECONDS, max_entries=config.LINE_EVENT_DEDUP_MEMORY_ENTRIES)
+
+# 処理権を取得したが完了・解放していないキー（インスタンス終了時に解放する）
+_in_flight = set()
+_in_flight_lock = threading.Lock()
+
+_stats_lock = threading.Lock()
+_stats = {
+    "checked": 0,
+    "accepted": 0,
+    "dropped_memory": 0,
+    "dropped_firestore": 0,
+    "redeliveries": 0,
+    "released": 0
+}
+
+def _count(key: str, n: int = 1):
+    with _stats_lock:
+        _stats[key] += n
+
+def _dedup_keys(event) -> list:
+    """イベントの重複判定キー（Webhookイベント ID とメッセージ ID）"""
+    keys = []
+    webhook_event_id = getattr(event, "webhook_event_id", None)
+    if webhook_event_id:
+        keys.append(f"evt_{webhook_event_id}")
+    message = getattr(event, "message", None)
+    message_id = getattr(message, "id", None)
+    if message_id:
+        keys.append(f"msg_{message_id}")
+    return keys
+
+def _is_redelivery(event) -> bool:
+    delivery_context = getattr(event, "delivery_context", None)
+    return bool(getattr(delivery_context, "is_redelivery", False))
+
+def claim_event(event) -> bool:
+    """イベントの処理権を取得（既に処理済みならFalse）
+
+    ダウンロードやGemini解析の前に呼び出すこと。
+    """
+    keys = _dedup_keys(event)
+    _count("checked")
+    if _is_redelivery(event):
+        _count("redeliveries")
+
+    if not keys:
+        _count("accepted")
+        return True
+
+    # 1. プロセス内キャッシュ
+    if any(_seen.get(key) for key in keys):
+        _count("dropped_memory")
+        print(f"[DEDUP] Duplicate event dropped (memory): {keys}")
+        return False
+
+    # 2. Firestore（インスタンス間で共有）
+    expires_at = datetime.now(timezone.utc) + timedelta(seconds=config.LINE_EVENT_DEDUP_TTL_SECONDS)
+    claimed = []
+    for key in keys:
+        try:
+            db.collection(config.COL_LINE_EVENTS).document(key).create({
+                "created_at": firestore.SERVER_TIMESTAMP,
+                "expires_at": expires_at,  # FirestoreのTTLポリシー対象フィールド
+                "redelivery": _is_redelivery(event)
+            })
+            claimed.append(key)
+        except AlreadyExists:
+            # 途中まで取得したキーは戻す
+            for claimed_key in claimed:
+                db.collection(config.COL_LINE_EVENTS).document(claimed_key).delete()
+            for k in keys:
+                _seen.set(k, True)
+            _count("dropped_firestore")
+            print(f"[DEDUP] Duplicate event dropped (firestore): {keys}")
+            return False
+
+    for key in keys:
+        _seen.set(key, True)
+    with _in_flight_lock:
+        _in_flight.update(keys)
+    _count("accepted")
+    return True
+
+def finish_event(event):
+    """イベントの処理完了を記録（処理権はTTLまで保持し、再送を重複として扱う）"""
+    with _in_flight_lock:
+        _in_flight.difference_update(_dedup_keys(event))
+
+def _release_keys(keys: list):
+    for key in keys:
+        _seen.delete(key)
+        try:
+            db.collection(config.COL_LINE_EVENTS).document(key).delete()
+        except Exception as e:
+            print(f"[DEDUP] Failed to release {key}: {e}")
+
+def release_event(event):
+    """処理に失敗したイベントの処理権を解放（再送時に再処理できるようにする）"""
+    keys = _dedup_keys(event)
+    with _in_flight_lock:
+        _in_flight.difference_update(keys)
+    _release_keys(keys)
+    _count("released")
+
+def release_in_flight():
+    """処理中のまま残っている処理権をすべて解放（インスタンス終了時に呼び出す）"""
+    with _in_flight_lock:
+        keys = list(_in_flight)
+        _in_flight.clear()
+    if not keys:
+        return
+    print(f"[DEDUP] Releasing {len(keys)} in-flight keys on shutdown")
+    _release_keys(keys)
+    _count("released", len(keys))
+
+def get_dedup_stats() -> dict:
+    """重複排除のカウンタを取得"""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["dropped_total"] = stats["dropped_memory"] + stats["dropped_firestore"]
+    stats["cache"] = _seen.stats()
+    return stats
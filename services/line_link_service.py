@@ -0,0 +1,92 @@
+"""
+LINE連携サービス
+LINEユーザーIDとアプリのユーザーIDの対応（line_users/{line_user_id}）を管理し、プロセス内でキャッシュ
+"""
+from google.cloud import firestore
+from database import db
+from services.user_service import get_user_doc, apply_user_update, invalidate_user
+from services.invalidation_service import register_handler, publish_invalidation
+from utils.ttl_cache import TTLCache
+import config
+
+# 未連携のLINEユーザーも "" としてキャッシュし、画像のたびに問い合わせないようにする
+_NOT_LINKED = ""
+_line_user_cache = TTLCache(config.LINE_USER_CACHE_TTL_SECONDS, max_entries=config.LINE_USER_CACHE_MAX_ENTRIES)
+
+def line_user_ref(line_user_id: str):
+    """LINEユーザーの対応ドキュメント"""
+    return db.collection(config.COL_LINE_USERS).document(line_user_id)
+
+def get_user_by_line_id(line_user_id: str):
+    """LINE User IDからユーザーIDを取得（未連携ならNone）"""
+    cached = _line_user_cache.get(line_user_id)
+    if cached is not None:
+        return cached or None
+
+    mapping_doc = line_user_ref(line_user_id).get()
+    if mapping_doc.exists:
+        user_id = mapping_doc.to_dict().get("user_id")
+    elif config.LINE_USER_INDEX_LEGACY_LOOKUP:
+        # 対応ドキュメントのない移行前の連携はクエリで探して作成
+        users = list(db.collection(config.COL_USERS).where("line_user_id", "==", line_user_id).limit(1).stream())
+        user_id = users[0].id if users else None
+        if user_id:
+            line_user_ref(line_user_id).set({"user_id": user_id, "linked_at": firestore.SERVER_TIMESTAMP})
+    else:
+        user_id = None
+
+    _line_user_cache.set(line_user_id, user_id or _NOT_LINKED)
+    return user_id
+
+def link_line_user(user_id: str, line_user_id: str):
+    """ユーザーとLINEユーザーを連携（以前の連携は解除）"""
+    user_data = get_user_doc(user_id, use_cache=False) or {}
+    previous_line_user_id = user_data.get("line_user_id")
+    previous_user_id = get_user_by_line_id(line_user_id)
+
+    batch = db.batch()
+    batch.update(db.collection(config.COL_USERS).document(user_id), {"line_user_id": line_user_id})
+    batch.set(line_user_ref(line_user_id), {"user_id": user_id, "linked_at": firestore.SERVER_TIMESTAMP})
+    if previous_line_user_id and previous_line_user_id != line_user_id:
+        batch.delete(line_user_ref(previous_line_user_id))
+    if previous_user_id and previous_user_id != user_id:
+        # 同じLINEアカウントが別ユーザーに連携されていた場合はそちらを解除
+        batch.update(db.collection(config.COL_USERS).document(previous_user_id), {"line_user_id": None})
+    batch.commit()
+
+    apply_user_update(user_id, {"line_user_id": line_user_id})
+    if previous_line_user_id:
+        invalidate_line_user(previous_line_user_id)
+    if previous_user_id and previous_user_id != user_id:
+        invalidate_user(previous_user_id)
+    _line_user_cache.set(line_user_id, user_id)
+    publish_invalidation("line_user", line_user_id)
+
+def unlink_line_user(user_id: str):
+    """ユーザーのLINE連携を解除"""
+    user_data = get_user_doc(user_id, use_cache=False) or {}
+    line_user_id = user_data.get("line_user_id")
+
+    batch = db.batch()
+    batch.update(db.collection(config.COL_USERS).document(user_id), {"line_user_id": None})
+    if line_user_id:
+        batch.delete(line_user_ref(line_user_id))
+    batch.commit()
+
+    apply_user_update(user_id, {"line_user_id": None})
+    if line_user_id:
+        invalidate_line_user(line_user_id)
+
+def _drop_line_user(line_user_id: str, value=None):
+    _line_user_cache.delete(line_user_id)
+
+def invalidate_line_user(line_user_id: str):
+    """対応キャッシュを破棄（ユーザー削除時など。他インスタンスにも通知）"""
+    _drop_line_user(line_user_id)
+    publish_invalidation("line_user", line_user_id)
+
+register_handler("line_user", _drop_line_user)
+
+def get_line_link_cache_stats() -> dict:
+    """対応キャッシュのヒット・ミス数を取得"""
+    return _line_user_cache.stats()
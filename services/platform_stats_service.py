@@ -0,0 +1,113 @@
+"""
+全体統計サービス
+プラン別ユーザー数・レコード総数・月別の登録件数を集計クエリ（count / sum）で求め、
+集計結果を platform_stats/summary に保存して使い回す（ユーザーやレコードを読み込まない）
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from database import db
+from utils.ttl_cache import TTLCache
+import config
+
+# 集計ドキュメントの読み込みもインスタンス内で短時間使い回す
+_stats_cache = TTLCache(config.PLATFORM_STATS_CACHE_SECONDS, max_entries=1)
+
+# 古くなった集計の再計算はバックグラウンドで1件ずつ（同時に複数の再計算を走らせない）
+_refresh_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="platform-stats")
+_refresh_lock = threading.Lock()
+
+def summary_ref():
+    """全体統計の集計ドキュメント（platform_stats/summary）"""
+    return db.collection(config.COL_PLATFORM_STATS).document("summary")
+
+def _aggregate(query, sum_field: str = None) -> dict:
+    """件数（と合計）を1回の集計クエリで取得"""
+    aggregation = query.count(alias="count")
+    if sum_field:
+        aggregation = aggregation.sum(sum_field, alias="sum")
+    results = {result.alias: result.value for result in aggregation.get()[0]}
+    return {"count": results.get("count", 0), "sum": results.get("sum", 0) or 0}
+
+def _month_starts(months: int) -> list:
+    """今月を含む直近 months か月の月初（古い順）"""
+    now = datetime.now(timezone.utc)
+    year, month = now.year, now.month
+    starts = []
+    for _ in range(months):
+        starts.append(datetime(year, month, 1, tzinfo=timezone.utc))
+        year, month = (year - 1, 12) if month == 1 else (year, month - 1)
+    return list(reversed(starts))
+
+def compute_platform_stats() -> dict:
+    """集計クエリで全体統計を計算して集計ドキュメントに保存"""
+    users = db.collection(config.COL_USERS)
+    records = db.collection_group("records")
+
+    users_by_plan = {
+        plan_id: _aggregate(users.where("subscription.plan", "==", plan_id))["count"]
+        for plan_id in config.PLANS
+    }
+    total = _aggregate(records, "total_amount")
+
+    # 月別の登録件数・金額（created_at の範囲ごとに集計）
+    starts = _month_starts(config.PLATFORM_STATS_MONTHS)
+    by_month = {}
+    for i, start in enumerate(starts):
+        query = records.where("created_at", ">=", start)
+        if i + 1 < len(starts):
+            query = query.where("created_at", "<", starts[i + 1])
+        month_total = _aggregate(query, "total_amount")
+        by_month[start.strftime("%Y-%m")] = {"count": month_total["count"], "amount": month_total["sum"]}
+
+    stats = {
+        "total_users": _aggregate(users)["count"],
+        "users_by_plan": users_by_plan,
+        "total_records": total["count"],
+        "total_amount": total["sum"],
+        "by_month": by_month,
+        "computed_at": datetime.now(timezone.utc)
+    }
+    summary_ref().set(stats)
+    _stats_cache.set("summary", stats)
+    return stats
+
+def _refresh_in_background():
+    """再計算中でなければバックグラウンドで再計算を開始"""
+    if not _refresh_lock.acquire(blocking=False):
+        return
+
+    def run():
+        try:
+            compute_platform_stats()
+        except Exception as e:
+            print(f"[ERROR] Platform stats refresh failed: {str(e)}")
+        finally:
+            _refresh_lock.release()
+
+    _refresh_executor.submit(run)
+
+def get_platform_stats(refresh: bool = False) -> dict:
+    """全体統計を取得
+
+    集計ドキュメントが PLATFORM_STATS_REFRESH_SECONDS より古ければ、保存済みの値をそのまま返し
+    バックグラウンドで再計算する（集計ドキュメントがまだない場合のみ待って計算する）。
+    """
+    if refresh:
+        return compute_platform_stats()
+
+    stats = _stats_cache.get("summary")
+    if stats is None:
+        doc = summary_ref().get()
+        stats = doc.to_dict() if doc.exists else None
+        # キャッシュするのはFirestoreから読み込んだ時だけ（読み込みのたびに期限を延ばさない）
+        if stats is not None:
+            _stats_cache.set("summary", stats)
+
+    computed_at = (stats or {}).get("computed_at")
+    if computed_at is None:
+        return compute_platform_stats()
+    if (datetime.now(timezone.utc) - computed_at).total_seconds() > config.PLATFORM_STATS_REFRESH_SECONDS:
+        _refresh_in_background()
+
+    return stats
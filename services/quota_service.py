@@ -0,0 +1,67 @@
+"""
+使用回数（クォータ）サービス
+バッチ処理の前に必要数をまとめて予約し、処理後に使わなかった分を返却する
+"""
+from google.cloud import firestore
+from database import db
+from services.event_service import event_broker
+from services.user_service import get_user_doc, apply_user_update
+from services.usage_service import is_sharded, get_shard_total, increment_usage
+import config
+
+class QuotaReservation:
+    """予約済みの使用回数
+
+    予約時点で使用回数に加算済み。処理後に commit(実際の使用数) で差分を返却する。
+    """
+
+    def __init__(self, u_id: str, requested: int, granted: int):
+        self.u_id = u_id
+        self.requested = requested
+        self.granted = granted
+        self._settled = False
+
+    def commit(self, consumed: int):
+        """実際に使用した数を確定し、残りを返却"""
+        if self._settled:
+            return
+        self._settled = True
+        refund = self.granted - min(max(consumed, 0), self.granted)
+        if refund > 0:
+            increment_usage(self.u_id, -refund)
+
+    def release(self):
+        """予約をすべて返却（処理全体が失敗した場合）"""
+        self.commit(0)
+
+def reserve_quota(u_id: str, requested: int) -> QuotaReservation:
+    """残り回数の範囲で最大 requested 件を1トランザクションで予約
+
+    同時に実行された予約が上限を超えて通ることはない。granted が 0 なら上限に達している。
+    ユーザードキュメントへの書き込みはバッチごとに1回。分散カウンターのユーザーは
+    シャードの合計（減算のみ・0以下）の概算値を加えて判定する。概算値は実際より減算が少ないため、上限は超えない。
+    """
+    if requested <= 0:
+        return QuotaReservation(u_id, requested, 0)
+
+    user_data = get_user_doc(u_id)
+    shard_total = get_shard_total(u_id) if user_data is not None and is_sharded(user_data) else 0
+    user_ref = db.collection(config.COL_USERS).document(u_id)
+
+    @firestore.transactional
+    def _reserve(transaction):
+        snapshot = user_ref.get(transaction=transaction)
+        if not snapshot.exists:
+            return 0
+        subscription = snapshot.to_dict().get("subscription", {})
+        remaining = max(subscription.get("limit", 10) - subscription.get("used", 0) - shard_total, 0)
+        granted = min(requested, remaining)
+        if granted > 0:
+            transaction.update(user_ref, {"subscription.used": firestore.Increment(granted)})
+        return granted
+
+    granted = _reserve(db.transaction())
+    if granted > 0:
+        apply_user_update(u_id, {"subscription.used": firestore.Increment(granted)})
+        event_broker.publish(u_id, "quota_changed", {"delta": granted})
+    return QuotaReservation(u_id, requested, granted)
@@ -0,0 +1,433 @@
+"""
+レコードサービス
+レコードの変更履歴（updated_at・削除記録）・差分取得・店舗名検索・集計ドキュメントを管理
+"""
+import re
+import random
+from datetime import datetime, timedelta, timezone
+from google.cloud import firestore
+from database import db
+from services.event_service import event_broker
+from services.user_service import get_user_doc
+from services.usage_service import is_sharded, add_usage_write, apply_usage_delta
+from utils.helpers import normalize_search_text, make_search_ngrams
+import config
+
+def records_collection(u_id: str):
+    """ユーザーのレコードサブコレクション"""
+    return db.collection(config.COL_USERS).document(u_id).collection("records")
+
+def public_record(data: dict, record_id: str) -> dict:
+    """APIレスポンス・エクスポート用のレコード（内部フィールドを除き、idを付与）"""
+    record = {k: v for k, v in data.items() if k not in config.RECORD_INTERNAL_FIELDS}
+    record["id"] = record_id
+    return record
+
+def tombstones_collection(u_id: str):
+    """ユーザーの削除記録サブコレクション"""
+    return db.collection(config.COL_USERS).document(u_id).collection(config.COL_RECORD_TOMBSTONES)
+
+def write_tombstone(batch, u_id: str, record_id: str):
+    """削除記録を書き込む（差分同期でクライアントに削除を伝えるため）
+
+    expires_at のTTLポリシーで保持期間後に自動削除する:
+        gcloud firestore fields ttls update expires_at --collection-group=record_tombstones --enable-ttl
+    """
+    batch.set(tombstones_collection(u_id).document(record_id), {
+        "id": record_id,
+        "deleted_at": firestore.SERVER_TIMESTAMP,
+        "updated_at": firestore.SERVER_TIMESTAMP,
+        "expires_at": datetime.now(timezone.utc) + timedelta(days=config.RECORD_TOMBSTONE_RETENTION_DAYS)
+    })
+
+def get_record_changes(u_id: str, since: datetime, limit: int) -> dict:
+    """指定時刻以降に変更・削除されたレコードを取得
+
+    境界の取りこぼしを防ぐため since と同時刻の変更も含める（重複はクライアント側でIDにより統合）。
+    since が削除記録の保持期間より古い場合は削除を取りこぼすため、差分ではなく全件再取得（full_resync）を返す。
+    """
+    retention_start = datetime.now(timezone.utc) - timedelta(days=config.RECORD_TOMBSTONE_RETENTION_DAYS)
+    if since < retention_start:
+        return {"upserts": [], "deleted": [], "watermark": None, "has_more": False, "full_resync": True}
+
+    upsert_docs = list(
+        records_collection(u_id)
+        .where("updated_at", ">=", since)
+        .order_by("updated_at")
+        .limit(limit)
+        .stream()
+    )
+    tombstone_docs = list(
+        tombstones_collection(u_id)
+        .where("updated_at", ">=", since)
+        .order_by("updated_at")
+        .limit(limit)
+        .stream()
+    )
+
+    upserts = [public_record(doc.to_dict(), doc.id) for doc in upsert_docs]
+    deleted = [doc.id for doc in tombstone_docs]
+
+    # 次回の基準時刻（件数上限に達した側は最後の時刻までしか進めない）
+    has_more = len(upsert_docs) >= limit or len(tombstone_docs) >= limit
+    candidates = []
+    for docs in (upsert_docs, tombstone_docs):
+        if docs:
+            candidates.append(docs[-1].get("updated_at"))
+    if not candidates:
+        watermark = since
+    elif has_more:
+        watermark = min(
+            docs[-1].get("updated_at")
+            for docs in (upsert_docs, tombstone_docs)
+            if len(docs) >= limit
+        )
+    else:
+        watermark = max(candidates)
+
+    return {
+        "upserts": upserts,
+        "deleted": deleted,
+        "watermark": watermark,
+        "has_more": has_more,
+        "full_resync": False
+    }
+
+def search_records_by_vendor(u_id: str, keyword: str, limit: int) -> list:
+    """店舗名で検索（n-gramインデックスで候補を絞り、正規化した文字列の部分一致で確定）
+
+    全角半角・大文字小文字・カタカナひらがなの違いは区別しない。新しい順に最大limit件。
+    """
+    needle = normalize_search_text(keyword)
+    if not needle:
+        return []
+    # 2文字以上なら先頭の2-gram、1文字ならその文字で候補を取得
+    gram = needle[:2]
+
+    query = (
+        records_collection(u_id)
+        .where("vendor_ngrams", "array_contains", gram)
+        .order_by("created_at", direction=firestore.Query.DESCENDING)
+        .limit(config.VENDOR_SEARCH_SCAN_LIMIT)
+    )
+    results = []
+    for doc in query.stream():
+        data = doc.to_dict()
+        if needle not in normalize_search_text(data.get("vendor_name")):
+            continue
+        results.append(public_record(data, doc.id))
+        if len(results) >= limit:
+            break
+    return results
+
+# ========== 集計ドキュメント ==========
+
+def summary_ref(u_id: str):
+    """ユーザーの集計ドキュメント（users/{id}/stats/summary）"""
+    return db.collection(config.COL_USERS).document(u_id).collection(config.COL_USER_STATS).document("summary")
+
+def summary_shard_refs(u_id: str) -> list:
+    """分散カウンターのユーザーの集計シャード（users/{id}/stats/summary_{n}）"""
+    stats_ref = db.collection(config.COL_USERS).document(u_id).collection(config.COL_USER_STATS)
+    return [stats_ref.document(f"summary_{n}") for n in range(config.USAGE_SHARD_COUNT)]
+
+def _empty_summary() -> dict:
+    return {"total_count": 0, "total_amount": 0, "by_month": {}, "by_category": {}}
+
+def _merge_summary(target: dict, data: dict):
+    """集計（またはシャード）の値を target に足し込む"""
+    target["total_count"] += data.get("total_count", 0)
+    target["total_amount"] += data.get("total_amount", 0)
+    for section in ("by_month", "by_category"):
+        for key, entry in (data.get(section) or {}).items():
+            merged = target[section].setdefault(key, {"count": 0, "amount": 0})
+            merged["count"] += entry.get("count", 0)
+            merged["amount"] += entry.get("amount", 0)
+
+def _record_keys(record: dict) -> tuple:
+    """集計キー（年月・カテゴリ）と金額を取り出す"""
+    date_value = record.get("date")
+    month = date_value[:7] if isinstance(date_value, str) and re.match(r'^\d{4}-\d{2}', date_value) else "unknown"
+    category = record.get("category") or "その他"
+    try:
+        amount = int(record.get("total_amount") or 0)
+    except (ValueError, TypeError):
+        amount = 0
+    return month, category, amount
+
+def summary_delta(removed: list = (), added: list = ()) -> dict:
+    """レコードの追加・削除（更新は削除+追加）に伴う集計ドキュメントの差分を作成
+
+    戻り値は set(..., merge=True) にそのまま渡せる Increment の入れ子辞書。
+    """
+    total = [0, 0]
+    sections = {"by_month": {}, "by_category": {}}
+
+    for records, sign in ((removed, -1), (added, 1)):
+        for record in records:
+            month, category, amount = _record_keys(record)
+            total[0] += sign
+            total[1] += sign * amount
+            for section, key in (("by_month", month), ("by_category", category)):
+                counter = sections[section].setdefault(key, [0, 0])
+                counter[0] += sign
+                counter[1] += sign * amount
+
+    delta = {"updated_at": firestore.SERVER_TIMESTAMP}
+    if total[0]:
+        delta["total_count"] = firestore.Increment(total[0])
+    if total[1]:
+        delta["total_amount"] = firestore.Increment(total[1])
+    for section, counters in sections.items():
+        for key, (count, amount) in counters.items():
+            entry = {}
+            if count:
+                entry["count"] = firestore.Increment(count)
+            if amount:
+                entry["amount"] = firestore.Increment(amount)
+            if entry:
+                delta.setdefault(section, {})[key] = entry
+    return delta
+
+def apply_summary_delta(writer, u_id: str, removed: list = (), added: list = (), sharded: bool = False):
+    """バッチ／トランザクションに集計ドキュメントの更新を追加
+
+    sharded=True（分散カウンターのユーザー）なら集計シャードのどれか1つに書き込む。
+    """
+    ref = random.choice(summary_shard_refs(u_id)) if sharded else summary_ref(u_id)
+    writer.set(ref, summary_delta(removed, added), merge=True)
+
+def _is_sharded_user(u_id: str) -> bool:
+    return is_sharded(get_user_doc(u_id))
+
+def insert_records_transactional(u_id: str, items: list):
+    """レコード追加・集計・最新一覧の更新を1トランザクションで実行
+
+    itemsは保存するレコード（"id"を含む）。書き込み上限のため1回450件までにすること。
+    使用回数は quota_service の予約で事前に加算しておく。
+    分散カウンターのユーザーは集計をシャードに書き込み、最新一覧ドキュメントは更新しない
+    （同じドキュメントへの書き込みが集中しないように）。
+    """
+    records_ref = records_collection(u_id)
+    sharded = _is_sharded_user(u_id)
+
+    @firestore.transactional
+    def _insert(transaction):
+        recent = None if sharded else _read_recent(transaction, u_id)
+        for item in items:
+            transaction.set(records_ref.document(item["id"]), item)
+        apply_summary_delta(transaction, u_id, added=items, sharded=sharded)
+        if recent is not None:
+            # 新しいものが先頭（items は古い順に並んでいる）
+            compact = [compact_record(item) for item in reversed(items)]
+            _write_recent(transaction, u_id, compact + recent["records"], recent["stale"])
+
+    _insert(db.transaction())
+
+    for item in items:
+        event_broker.publish(u_id, "record_created", compact_record(item))
+
+def update_record_transactional(u_id: str, record_id: str, update_data: dict):
+    """レコード更新と集計・最新一覧の反映を1トランザクションで実行（存在しなければNone）"""
+    doc_ref = records_collection(u_id).document(record_id)
+    sharded = _is_sharded_user(u_id)
+
+    @firestore.transactional
+    def _update(transaction):
+        snapshot = doc_ref.get(transaction=transaction)
+        if not snapshot.exists:
+            return None
+        recent = None if sharded else _read_recent(transaction, u_id)
+        old_record = snapshot.to_dict()
+        new_record = {**old_record, **update_data, "id": record_id}
+        write_data = {**update_data, "updated_at": firestore.SERVER_TIMESTAMP}
+        if "vendor_name" in update_data:
+            # 店舗名の検索インデックスも更新
+            write_data["vendor_ngrams"] = make_search_ngrams(update_data["vendor_name"])
+        transaction.update(doc_ref, write_data)
+        apply_summary_delta(transaction, u_id, removed=[old_record], added=[new_record], sharded=sharded)
+        if recent is not None and any(r.get("id") == record_id for r in recent["records"]):
+            records = [compact_record(new_record) if r.get("id") == record_id else r for r in recent["records"]]
+            _write_recent(transaction, u_id, records, recent["stale"])
+        return new_record
+
+    new_record = _update(db.transaction())
+    if new_record is not None:
+        event_broker.publish(u_id, "record_updated", compact_record(new_record))
+    return new_record
+
+def delete_record_transactional(u_id: str, record_id: str, decrement_usage: bool = True):
+    """レコード削除・削除記録・集計・最新一覧の反映を1トランザクションで実行（削除したレコードを返す）"""
+    doc_ref = records_collection(u_id).document(record_id)
+    user_data = get_user_doc(u_id) or {}
+    sharded = is_sharded(user_data)
+
+    @firestore.transactional
+    def _delete(transaction):
+        snapshot = doc_ref.get(transaction=transaction)
+        if not snapshot.exists:
+            return None
+        recent = None if sharded else _read_recent(transaction, u_id)
+        old_record = snapshot.to_dict()
+        transaction.delete(doc_ref)
+        write_tombstone(transaction, u_id, record_id)
+        apply_summary_delta(transaction, u_id, removed=[old_record], sharded=sharded)
+        if recent is not None and any(r.get("id") == record_id for r in recent["records"]):
+            records = [r for r in recent["records"] if r.get("id") != record_id]
+            # 一覧が満杯だった場合、次に古いレコードを補充する必要がある
+            stale = recent["stale"] or len(recent["records"]) >= config.RECENT_RECORDS_LIMIT
+            _write_recent(transaction, u_id, records, stale)
+        if decrement_usage:
+            add_usage_write(transaction, u_id, user_data, -1)
+        return old_record
+
+    old_record = _delete(db.transaction())
+    if old_record is not None:
+        event_broker.publish(u_id, "record_deleted", {"id": record_id})
+        if decrement_usage:
+            apply_usage_delta(u_id, user_data, -1)
+    return old_record
+
+def rebuild_summary(u_id: str) -> dict:
+    """全レコードから集計ドキュメントを作り直す（移行・不整合の修復用。集計シャードは削除）"""
+    records = [doc.to_dict() for doc in records_collection(u_id).stream()]
+    summary = _empty_summary()
+    for record in records:
+        month, category, amount = _record_keys(record)
+        summary["total_count"] += 1
+        summary["total_amount"] += amount
+        for section, key in (("by_month", month), ("by_category", category)):
+            entry = summary[section].setdefault(key, {"count": 0, "amount": 0})
+            entry["count"] += 1
+            entry["amount"] += amount
+    batch = db.batch()
+    batch.set(summary_ref(u_id), {**summary, "updated_at": firestore.SERVER_TIMESTAMP})
+    for shard_ref in summary_shard_refs(u_id):
+        batch.delete(shard_ref)
+    batch.commit()
+    return summary
+
+def _load_summary(u_id: str, sharded: bool):
+    """集計ドキュメント（分散カウンターのユーザーはシャードも合算）を読み込む（どれも未作成ならNone）"""
+    refs = [summary_ref(u_id)] + (summary_shard_refs(u_id) if sharded else [])
+    summary = _empty_summary()
+    found = False
+    for snapshot in db.get_all(refs):
+        if snapshot.exists:
+            found = True
+            _merge_summary(summary, snapshot.to_dict())
+    return summary if found else None
+
+def get_summary(u_id: str) -> dict:
+    """集計を取得（未作成なら空の集計）"""
+    return _load_summary(u_id, _is_sharded_user(u_id)) or _empty_summary()
+
+def fold_summary_shards(u_id: str):
+    """集計シャードを集計ドキュメントに繰り入れて削除し、最新一覧を作り直し対象にする
+
+    プラン変更（分散カウンターの対象の切り替え）時・定期集計で呼び出す。
+    分散カウンターの間は最新一覧ドキュメントを更新していないため、stale にしておく。
+    """
+    shard_refs = summary_shard_refs(u_id)
+
+    @firestore.transactional
+    def _fold(transaction):
+        snapshots = list(transaction.get_all([summary_ref(u_id)] + shard_refs))
+        shard_snapshots = [s for s in snapshots if s.exists and s.reference.id != "summary"]
+        if not shard_snapshots:
+            return
+        summary = _empty_summary()
+        for snapshot in snapshots:
+            if snapshot.exists:
+                _merge_summary(summary, snapshot.to_dict())
+        transaction.set(summary_ref(u_id), {**summary, "updated_at": firestore.SERVER_TIMESTAMP})
+        for snapshot in shard_snapshots:
+            transaction.delete(snapshot.reference)
+
+    _fold(db.transaction())
+    recent_ref(u_id).set({"stale": True}, merge=True)
+
+# ========== 最新レコード一覧 ==========
+
+# 最新一覧に保持するフィールド（一覧表示に必要なもののみ）
+RECENT_RECORD_FIELDS = ["id", "date", "vendor_name", "total_amount", "category", "image_url", "is_pdf", "pdf_images"]
+
+def recent_ref(u_id: str):
+    """ユーザーの最新レコード一覧ドキュメント（users/{id}/stats/recent）"""
+    return db.collection(config.COL_USERS).document(u_id).collection(config.COL_USER_STATS).document("recent")
+
+def compact_record(record: dict) -> dict:
+    """最新一覧用にレコードを縮約"""
+    return {field: record.get(field) for field in RECENT_RECORD_FIELDS if field in record}
+
+def _read_recent(transaction, u_id: str) -> dict:
+    snapshot = recent_ref(u_id).get(transaction=transaction)
+    data = snapshot.to_dict() if snapshot.exists else {}
+    return {
+        "records": data.get("records", []),
+        # 未作成の場合は次回読み込み時に全件から作り直す
+        "stale": data.get("stale", True) if snapshot.exists else True
+    }
+
+def _write_recent(writer, u_id: str, records: list, stale: bool):
+    writer.set(recent_ref(u_id), {
+        "records": records[:config.RECENT_RECORDS_LIMIT],
+        "stale": stale,
+        "updated_at": firestore.SERVER_TIMESTAMP
+    })
+
+def _recent_query(u_id: str):
+    return (
+        records_collection(u_id)
+        .order_by("created_at", direction=firestore.Query.DESCENDING)
+        .limit(config.RECENT_RECORDS_LIMIT)
+    )
+
+def rebuild_recent(u_id: str) -> list:
+    """レコードサブコレクションから最新一覧を作り直す"""
+    query = _recent_query(u_id)
+
+    @firestore.transactional
+    def _rebuild(transaction):
+        records = []
+        for doc in transaction.get(query):
+            data = doc.to_dict()
+            data["id"] = doc.id
+            records.append(compact_record(data))
+        _write_recent(transaction, u_id, records, False)
+        return records
+
+    return _rebuild(db.transaction())
+
+def get_recent_records(u_id: str) -> dict:
+    """最新一覧と総件数を取得（通常は最新一覧・集計の2ドキュメントを1往復で読み込み）
+
+    分散カウンターのユーザーは最新一覧ドキュメントを更新していないため、レコードを直接クエリする。
+    """
+    if _is_sharded_user(u_id):
+        records = [compact_record(public_record(doc.to_dict(), doc.id)) for doc in _recent_query(u_id).stream()]
+        summary = _load_summary(u_id, sharded=True)
+    else:
+        recent_snapshot, summary_snapshot = None, None
+        for snapshot in db.get_all([recent_ref(u_id), summary_ref(u_id)]):
+            if snapshot.reference.id == "recent":
+                recent_snapshot = snapshot
+            else:
+                summary_snapshot = snapshot
+
+        recent = recent_snapshot.to_dict() if recent_snapshot and recent_snapshot.exists else None
+        if recent is None or recent.get("stale"):
+            records = rebuild_recent(u_id)
+        else:
+            records = recent.get("records", [])
+        summary = summary_snapshot.to_dict() if summary_snapshot and summary_snapshot.exists else None
+
+    if summary is not None:
+        total = summary.get("total_count", 0)
+    else:
+        # 集計ドキュメントのない移行前のユーザーは集計クエリで件数を数える
+        total = records_collection(u_id).count(alias="total").get()[0][0].value
+    return {
+        "records": records,
+        "total": total
+    }
@@ -0,0 +1,125 @@
+"""
+使用回数カウンターサービス
+大量に登録するプランのユーザーは使用回数の減算（レコード削除・予約の返却）を
+分散カウンター（users/{id}/usage_shards/{n}）に書き込み、ユーザードキュメントへの書き込み集中を避ける
+
+使用回数 = subscription.used + 全シャードの合計
+加算はバッチ単位の予約（quota_service）でユーザードキュメントに直接行うため、シャードの合計は0以下になり、
+概算値を使った上限判定は常に安全側（実際より多く数える）になる。
+（reconcile_usage でシャードの合計を subscription.used に繰り入れる）
+"""
+import random
+from google.cloud import firestore
+from database import db
+from services.event_service import event_broker
+from services.user_service import get_user_doc, apply_user_update, invalidate_user
+from services.invalidation_service import register_handler, publish_invalidation
+from utils.ttl_cache import TTLCache
+import config
+
+# シャード合計の概算値（短時間キャッシュ。自分の加算はその場で反映）
+_shard_totals = TTLCache(config.USAGE_APPROX_TTL_SECONDS)
+
+def is_sharded(user_data: dict) -> bool:
+    """分散カウンターを使うユーザーか（プランで判定）"""
+    plan = (user_data or {}).get("subscription", {}).get("plan", "free")
+    return plan in config.USAGE_SHARDED_PLANS
+
+def shards_collection(u_id: str):
+    """ユーザーの使用回数シャード"""
+    return db.collection(config.COL_USERS).document(u_id).collection(config.COL_USAGE_SHARDS)
+
+def _use_shard(user_data: dict, delta: int) -> bool:
+    # 加算は上限判定と一緒にユーザードキュメントで行う（シャードには減算のみ）
+    return delta < 0 and is_sharded(user_data)
+
+def add_usage_write(writer, u_id: str, user_data: dict, delta: int):
+    """バッチ／トランザクションに使用回数の加算を追加
+
+    書き込み確定後に apply_usage_delta を呼んでキャッシュへ反映すること。
+    """
+    if _use_shard(user_data, delta):
+        shard_ref = shards_collection(u_id).document(str(random.randrange(config.USAGE_SHARD_COUNT)))
+        writer.set(shard_ref, {"count": firestore.Increment(delta)}, merge=True)
+    else:
+        writer.update(db.collection(config.COL_USERS).document(u_id), {
+            "subscription.used": firestore.Increment(delta)
+        })
+
+def apply_usage_delta(u_id: str, user_data: dict, delta: int):
+    """確定した加算をキャッシュに反映し、変更を通知"""
+    if _use_shard(user_data, delta):
+        total = _shard_totals.get(u_id)
+        if total is not None:
+            _shard_totals.set(u_id, total + delta)
+    else:
+        apply_user_update(u_id, {"subscription.used": firestore.Increment(delta)})
+    event_broker.publish(u_id, "quota_changed", {"delta": delta})
+
+def increment_usage(u_id: str, delta: int, user_data: dict = None):
+    """使用回数を加算（負の値で減算）"""
+    if user_data is None:
+        user_data = get_user_doc(u_id) or {}
+    batch = db.batch()
+    add_usage_write(batch, u_id, user_data, delta)
+    batch.commit()
+    apply_usage_delta(u_id, user_data, delta)
+
+def get_shard_total(u_id: str, exact: bool = False) -> int:
+    """シャードの合計（exact=False ならキャッシュ済みの概算値）"""
+    if not exact:
+        total = _shard_totals.get(u_id)
+        if total is not None:
+            return total
+    total = sum((doc.to_dict() or {}).get("count", 0) for doc in shards_collection(u_id).stream())
+    _shard_totals.set(u_id, total)
+    return total
+
+def get_used(u_id: str, user_data: dict, exact: bool = False) -> int:
+    """使用回数（分散カウンターのユーザーはシャードの合計を含む）"""
+    used = (user_data or {}).get("subscription", {}).get("used", 0)
+    if is_sharded(user_data):
+        used += get_shard_total(u_id, exact=exact)
+    return used
+
+def with_effective_usage(u_id: str, user_data: dict) -> dict:
+    """subscription.used をシャード込みの値にしたサブスク情報"""
+    subscription = dict((user_data or {}).get("subscription", {}))
+    if is_sharded(user_data):
+        subscription["used"] = get_used(u_id, user_data)
+    return subscription
+
+def reconcile_usage(u_id: str) -> int:
+    """シャードの合計を subscription.used に繰り入れてシャードを0に戻す（正確な値を返す）"""
+    user_ref = db.collection(config.COL_USERS).document(u_id)
+    shard_refs = [shards_collection(u_id).document(str(i)) for i in range(config.USAGE_SHARD_COUNT)]
+
+    @firestore.transactional
+    def _reconcile(transaction):
+        user_snapshot = user_ref.get(transaction=transaction)
+        if not user_snapshot.exists:
+            return None
+        shard_snapshots = list(transaction.get_all(shard_refs))
+        total = 0
+        for snapshot in shard_snapshots:
+            if snapshot.exists:
+                count = (snapshot.to_dict() or {}).get("count", 0)
+                if count:
+                    total += count
+                    transaction.set(snapshot.reference, {"count": 0})
+        used = user_snapshot.to_dict().get("subscription", {}).get("used", 0) + total
+        if total:
+            transaction.update(user_ref, {"subscription.used": used})
+        return used
+
+    used = _reconcile(db.transaction())
+    invalidate_user(u_id)
+    _shard_totals.set(u_id, 0)
+    # 他インスタンスの概算値はシャードを0に戻す前の合計なので破棄させる
+    publish_invalidation("usage", u_id)
+    return used
+
+def _drop_shard_total(u_id: str, value=None):
+    _shard_totals.delete(u_id)
+
+register_handler("usage", _drop_shard_total)
@@ -0,0 +1,238 @@
+"""
+ユーザードキュメントサービス
+users/{id} の読み込みをリクエスト単位・プロセス内TTLキャッシュで共有し、自分の更新はキャッシュへ書き込み反映
+（他インスタンスのキャッシュは無効化バスで破棄）
+"""
+import copy
+import hashlib
+import threading
+import unicodedata
+from fastapi import Depends, HTTPException
+from google.api_core.exceptions import AlreadyExists
+from google.cloud import firestore
+from database import db
+from services.auth_service import get_current_user
+from services.invalidation_service import register_handler, publish_invalidation
+from utils.ttl_cache import TTLCache
+import config
+
+_user_cache = TTLCache(config.USER_CACHE_TTL_SECONDS, max_entries=config.USER_CACHE_MAX_ENTRIES)
+
+_stats_lock = threading.Lock()
+_stats = {
+    "firestore_reads": 0,
+    "write_through": 0,
+    "invalidations": 0
+}
+
+def _count(key: str, n: int = 1):
+    with _stats_lock:
+        _stats[key] += n
+
+def get_user_doc(u_id: str, use_cache: bool = True):
+    """ユーザードキュメントを取得（存在しなければNone）
+
+    戻り値はキャッシュのコピーなので、呼び出し側で変更してよい。
+    """
+    if use_cache:
+        cached = _user_cache.get(u_id)
+        if cached is not None:
+            return copy.deepcopy(cached)
+
+    user_doc = db.collection(config.COL_USERS).document(u_id).get()
+    _count("firestore_reads")
+    if not user_doc.exists:
+        _user_cache.delete(u_id)
+        return None
+
+    user_data = user_doc.to_dict()
+    _user_cache.set(u_id, copy.deepcopy(user_data))
+    return user_data
+
+async def get_user_context(u_id: str = Depends(get_current_user)) -> dict:
+    """現在のユーザーのドキュメントを取得する依存関数（"id"付き）
+
+    FastAPIは同じ依存関数の結果を1リクエスト内で共有するため、
+    require_admin とエンドポイントの両方で使っても読み込みは1回になる。
+    """
+    user_data = get_user_doc(u_id)
+    if user_data is None:
+        raise HTTPException(status_code=404, detail="ユーザーが見つかりません")
+    user_data["id"] = u_id
+    return user_data
+
+async def get_fresh_user_context(u_id: str = Depends(get_current_user)) -> dict:
+    """キャッシュを使わずにユーザーのドキュメントを取得する依存関数（"id"付き）
+
+    使用回数の加算は他インスタンスに通知しないため、使用回数を表示するエンドポイントで使う。
+    """
+    user_data = get_user_doc(u_id, use_cache=False)
+    if user_data is None:
+        raise HTTPException(status_code=404, detail="ユーザーが見つかりません")
+    user_data["id"] = u_id
+    return user_data
+
+def _apply_field(data: dict, path: str, value) -> bool:
+    """ドット区切りのフィールドパスに値を反映（反映できない値ならFalse）"""
+    keys = path.split(".")
+    target = data
+    for key in keys[:-1]:
+        child = target.get(key)
+        if not isinstance(child, dict):
+            child = {}
+            target[key] = child
+        target = child
+
+    if isinstance(value, firestore.Increment):
+        current = target.get(keys[-1]) or 0
+        target[keys[-1]] = current + value.value
+    elif value is firestore.DELETE_FIELD:
+        target.pop(keys[-1], None)
+    elif value is firestore.SERVER_TIMESTAMP:
+        # サーバー側で決まる値は再読み込みさせる
+        return False
+    else:
+        target[keys[-1]] = copy.deepcopy(value)
+    return True
+
+def _must_broadcast(update_data: dict) -> bool:
+    """他インスタンスのキャッシュも破棄すべき更新か（ロール・プラン・LINE連携・トークンバージョン）"""
+    for path in update_data:
+        for field in config.USER_CACHE_BROADCAST_FIELDS:
+            if path == field or field.startswith(path + ".") or path.startswith(field + "."):
+                return True
+    return False
+
+def apply_user_update(u_id: str, update_data: dict):
+    """Firestoreに書き込み済みの更新をキャッシュにも反映
+
+    ロール・プランなどの更新は他インスタンスのキャッシュも破棄する。
+    使用回数の加算などは通知しない（使用回数を表示するエンドポイントは get_fresh_user_context で読み込む）。
+    """
+    if _must_broadcast(update_data):
+        publish_invalidation("user", u_id)
+    cached = _user_cache.get(u_id)
+    if cached is None:
+        return
+    updated = copy.deepcopy(cached)
+    for path, value in update_data.items():
+        if not _apply_field(updated, path, value):
+            _drop_user(u_id)
+            return
+    _user_cache.set(u_id, updated)
+    _count("write_through")
+
+def update_user(u_id: str, update_data: dict):
+    """ユーザードキュメントを更新し、キャッシュにも反映"""
+    db.collection(config.COL_USERS).document(u_id).update(update_data)
+    apply_user_update(u_id, update_data)
+
+def update_user_claims(u_id: str, update_data: dict) -> int:
+    """トークンのクレームに関わる項目（ロール・プラン）を更新し、発行済みトークンを失効させる
+
+    token_version を1つ進める。トークンの検証は保存済みの token_version と比較するため、
+    古いバージョンのトークンは全インスタンスで拒否され、リフレッシュで新しいクレームに入れ替わる。
+    更新後のバージョンを返す。
+    """
+    user_ref = db.collection(config.COL_USERS).document(u_id)
+
+    @firestore.transactional
+    def _update(transaction):
+        snapshot = user_ref.get(transaction=transaction)
+        if not snapshot.exists:
+            return None
+        version = (snapshot.to_dict().get("token_version") or 0) + 1
+        transaction.update(user_ref, {**update_data, "token_version": version})
+        return version
+
+    version = _update(db.transaction())
+    if version is None:
+        raise HTTPException(status_code=404, detail="ユーザーが見つかりません")
+    apply_user_update(u_id, {**update_data, "token_version": version})
+    return version
+
+def normalize_email(email: str) -> str:
+    """メールアドレスを索引用に正規化（全角半角の統一・前後の空白除去・小文字化）"""
+    return unicodedata.normalize("NFKC", email or "").strip().lower()
+
+def email_ref(email: str):
+    """メールアドレス索引ドキュメント（emails/{正規化したメールアドレスのSHA-256}）
+
+    メールアドレスには "/" などドキュメントIDに使えない文字が含まれうるため、ハッシュをIDにする。
+    """
+    normalized = normalize_email(email)
+    if not normalized:
+        raise HTTPException(status_code=400, detail="メールアドレスを入力してください")
+    return db.collection(config.COL_EMAILS).document(hashlib.sha256(normalized.encode("utf-8")).hexdigest())
+
+def create_user_with_email(user_id: str, user_data: dict) -> bool:
+    """メールアドレス索引とユーザーを1バッチで作成（登録済みのメールアドレスならFalse）
+
+    索引は create() で作るため、同時に登録されても片方だけが成功する。
+    管理画面の前方一致検索用に正規化したメールアドレス（email_normalized）も保存する。
+    """
+    batch = db.batch()
+    batch.create(email_ref(user_data["email"]), {
+        "user_id": user_id,
+        "email": normalize_email(user_data["email"]),
+        "created_at": firestore.SERVER_TIMESTAMP
+    })
+    batch.set(db.collection(config.COL_USERS).document(user_id), {
+        **user_data,
+        "email_normalized": normalize_email(user_data["email"])
+    })
+    try:
+        batch.commit()
+    except AlreadyExists:
+        return False
+    return True
+
+def find_user_by_email(email: str):
+    """メールアドレスからユーザーを取得（(user_id, ユーザーデータ) または None）
+
+    索引ドキュメントを直接読み込む。EMAIL_INDEX_LEGACY_LOOKUP が有効な間は、
+    索引のない移行前のユーザーをクエリで探して索引を作成する。
+    """
+    index_doc = email_ref(email).get()
+    if index_doc.exists:
+        user_id = index_doc.to_dict().get("user_id")
+        user_data = get_user_doc(user_id, use_cache=False)
+        return (user_id, user_data) if user_data is not None else None
+    if not config.EMAIL_INDEX_LEGACY_LOOKUP:
+        return None
+
+    users = list(db.collection(config.COL_USERS).where("email", "==", email).limit(1).stream())
+    if not users:
+        return None
+    try:
+        email_ref(email).create({
+            "user_id": users[0].id,
+            "email": normalize_email(email),
+            "created_at": firestore.SERVER_TIMESTAMP
+        })
+    except AlreadyExists:
+        pass
+    user_data = users[0].to_dict()
+    if user_data.get("email_normalized") != normalize_email(email):
+        users[0].reference.update({"email_normalized": normalize_email(email)})
+        user_data["email_normalized"] = normalize_email(email)
+    _user_cache.set(users[0].id, copy.deepcopy(user_data))
+    return users[0].id, user_data
+
+def _drop_user(u_id: str, value=None):
+    _user_cache.delete(u_id)
+    _count("invalidations")
+
+def invalidate_user(u_id: str):
+    """キャッシュを破棄（削除・他経路での更新時。他インスタンスにも通知）"""
+    _drop_user(u_id)
+    publish_invalidation("user", u_id)
+
+register_handler("user", _drop_user)
+
+def get_user_cache_stats() -> dict:
+    """キャッシュのヒット・ミス数とFirestore読み込み数を取得"""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["cache"] = _user_cache.stats()
+    return stats
@@ -31,10 +31,15 @@ export const state = {
     selectedFiles: [],
     editingRecordId: null,
     allRecords: [],
+    nextCursor: null,
+    totalRecords: 0,
     currentImageIndex: 0,
     currentImages: []
 };
 
+// レコード一覧の1ページあたりの件数
+export const RECORDS_PAGE_SIZE = 50;
+
 // カテゴリアイコン
 export const categoryIcons = {
     '食費': '🍽️',
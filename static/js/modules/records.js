@@ -3,7 +3,7 @@
  * アップロード・表示・編集・削除機能
  */
 
-import { state, categoryIcons } from './config.js';
+import { state, categoryIcons, RECORDS_PAGE_SIZE } from './config.js';
 import { authFetch, showLoading, hideLoading } from './utils.js';
 
 /**
@@ -11,17 +11,50 @@ import { authFetch, showLoading, hideLoading } from './utils.js';
  */
 export async function loadStatus() {
     try {
-        const res = await authFetch('/api/status');
-        const data = await res.json();
-        state.allRecords = data.records.reverse();
+        // プロフィール（サブスク・LINE連携状態）はユーザー情報1件の読み込みで取得
+        const res = await authFetch('/api/profile');
+        const profile = await res.json();
 
         // サブスク情報を表示
-        displaySubscriptionInfo(data.subscription);
+        displaySubscriptionInfo(profile.subscription);
+
+        // LINE連携ステータスを表示
+        displayLineStatus(profile.line_connected);
+
+        // レコードを表示（1ページ目）
+        await loadRecords(true);
+    } catch (e) {
+        console.error(e);
+    }
+}
+
+/**
+ * レコード一覧取得（カーソルページング）
+ */
+export async function loadRecords(reset = false) {
+    if (reset) {
+        state.allRecords = [];
+        state.nextCursor = null;
+    }
+
+    const params = new URLSearchParams({ limit: RECORDS_PAGE_SIZE });
+    if (state.nextCursor) {
+        params.set('cursor', state.nextCursor);
+    }
 
-        // LINE連携ステータスを確認
-        checkLineStatus();
+    // 1ページ目は最新一覧ドキュメントから取得（続きは通常のページング）
+    const url = reset ? '/api/records/recent' : `/api/records?${params}`;
+
+    try {
+        const res = await authFetch(url);
+        const data = await res.json();
+
+        state.allRecords = state.allRecords.concat(data.records);
+        state.nextCursor = data.next_cursor;
+        if (data.total !== null) {
+            state.totalRecords = data.total;
+        }
 
-        // レコードを表示
         applyFilters();
     } catch (e) {
         console.error(e);
@@ -73,22 +106,15 @@ function displaySubscriptionInfo(subscription) {
 }
 
 /**
- * LINE連携ステータス確認
+ * LINE連携ステータス表示
  */
-async function checkLineStatus() {
-    try {
-        const res = await authFetch('/api/line-status');
-        const data = await res.json();
-
-        if (data.connected) {
-            document.getElementById('lineConnected').classList.remove('hidden');
-            document.getElementById('lineNotConnected').classList.add('hidden');
-        } else {
-            document.getElementById('lineConnected').classList.add('hidden');
-            document.getElementById('lineNotConnected').classList.remove('hidden');
-        }
-    } catch (e) {
-        console.error(e);
+function displayLineStatus(connected) {
+    if (connected) {
+        document.getElementById('lineConnected').classList.remove('hidden');
+        document.getElementById('lineNotConnected').classList.add('hidden');
+    } else {
+        document.getElementById('lineConnected').classList.add('hidden');
+        document.getElementById('lineNotConnected').classList.remove('hidden');
     }
 }
 
@@ -0,0 +1,32 @@
+"""
+レスポンス圧縮ミドルウェア
+クライアントのAccept-Encodingに応じてbrotli/gzipで圧縮
+"""
+from starlette.middleware.gzip import GZipMiddleware
+
+try:
+    from brotli_asgi import BrotliMiddleware
+    BROTLI_SUPPORT = True
+except ImportError:
+    BROTLI_SUPPORT = False
+    print("警告: brotli-asgiがインストールされていません。gzip圧縮のみ有効です。")
+
+class CompressionMiddleware:
+    """brotli（非対応クライアントにはgzip）でレスポンスを圧縮
+
+    SSEなど逐次送信するパスは圧縮するとバッファリングされるため対象外にする。
+    """
+
+    def __init__(self, app, minimum_size: int = 1024, excluded_paths: list = ()):
+        self.app = app
+        self.excluded_paths = tuple(excluded_paths)
+        if BROTLI_SUPPORT:
+            self.compressed_app = BrotliMiddleware(app, minimum_size=minimum_size, gzip_fallback=True)
+        else:
+            self.compressed_app = GZipMiddleware(app, minimum_size=minimum_size)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and not scope["path"].startswith(self.excluded_paths):
+            await self.compressed_app(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
@@ -0,0 +1,56 @@
+"""
+高速JSONユーティリティ
+orjsonによるレスポンスのシリアライズと、大きな一覧のストリーミング出力
+"""
+import json
+from datetime import date, datetime
+from fastapi.responses import JSONResponse, StreamingResponse
+
+try:
+    import orjson
+    ORJSON_SUPPORT = True
+except ImportError:
+    ORJSON_SUPPORT = False
+    print("警告: orjsonがインストールされていません。標準のjsonモジュールを使用します。")
+
+def _default(obj):
+    """標準で変換できない値（Firestoreの日時・センチネルなど）の変換"""
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    return str(obj)
+
+def dumps(obj) -> bytes:
+    """オブジェクトをJSONのバイト列に変換"""
+    if ORJSON_SUPPORT:
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=_default).encode("utf-8")
+
+class FastJSONResponse(JSONResponse):
+    """orjsonでシリアライズするJSONレスポンス（アプリ全体の既定）"""
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+def iter_json_object(fields: dict, array_key: str, items):
+    """{...fields, array_key: [items...]} 形式のJSONを少しずつ生成
+
+    itemsはイテレータ（Firestoreのstreamなど）で、1件ずつシリアライズして出力する。
+    全件をメモリに載せずに済み、最初のバイトもすぐ返せる。
+    """
+    head = dumps(fields)
+    # 末尾の } を外して配列キーを続ける
+    yield head[:-1] + (b"," if fields else b"") + dumps(array_key) + b":["
+    first = True
+    for item in items:
+        if not first:
+            yield b","
+        yield dumps(item)
+        first = False
+    yield b"]}"
+
+def streaming_json_response(fields: dict, array_key: str, items) -> StreamingResponse:
+    """大きな一覧をストリーミングで返すレスポンス
+
+    同期イテレータはStarletteがスレッドプールで回すため、Firestoreの読み込みでイベントループを塞がない。
+    """
+    return StreamingResponse(iter_json_object(fields, array_key, items), media_type="application/json")
@@ -1,9 +1,12 @@
 """
 共通ヘルパー関数
 """
+import os
+import re
+import uuid
 import random
 import string
-from database import db
+import unicodedata
 import config
 
 def generate_user_id() -> str:
@@ -14,34 +17,73 @@ def generate_token(length=8) -> str:
     """LINE連携用トークンを生成"""
     return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
 
-def check_usage_limit(u_id: str) -> bool:
-    """使用上限をチェック"""
-    user_doc = db.collection(config.COL_USERS).document(u_id).get()
-    if not user_doc.exists:
-        return False
+def make_upload_path(prefix: str, ext: str) -> str:
+    """衝突しない一時ファイルパスを生成"""
+    return os.path.join(config.UPLOAD_DIR, f"{prefix}_{uuid.uuid4().hex}{ext}")
 
-    user_data = user_doc.to_dict()
-    subscription = user_data.get("subscription", {})
+def normalize_date(value):
+    """日付をYYYY-MM-DD形式の文字列に正規化（範囲検索できる形式に揃える）
 
-    used = subscription.get("used", 0)
-    limit = subscription.get("limit", 10)
+    解釈できない場合は元の値をそのまま返す。
+    """
+    if not isinstance(value, str):
+        return value
+    text = unicodedata.normalize("NFKC", value).strip()
+    match = re.match(r'^(\d{2,4})\s*[-/.年]\s*(\d{1,2})\s*[-/.月]\s*(\d{1,2})\s*日?', text)
+    if not match:
+        return value
+    year, month, day = (int(g) for g in match.groups())
+    if year < 100:
+        year += 2000  # 2桁の年は2000年代として解釈
+    if not (1 <= month <= 12 and 1 <= day <= 31):
+        return value
+    return f"{year:04d}-{month:02d}-{day:02d}"
 
-    return used < limit
+def normalize_amount(value) -> int:
+    """金額を整数に正規化（カンマ・円記号を除去）"""
+    if isinstance(value, bool):
+        raise ValueError("金額は数値で指定してください")
+    if isinstance(value, (int, float)):
+        return int(value)
+    text = unicodedata.normalize("NFKC", str(value)).replace(",", "").replace("¥", "").replace("円", "").strip()
+    return int(float(text))
 
-def get_user_subscription(u_id: str):
-    """ユーザーのサブスク情報を取得"""
-    user_doc = db.collection(config.COL_USERS).document(u_id).get()
-    if not user_doc.exists:
-        return None
+def normalize_search_text(value) -> str:
+    """検索用に文字列を正規化（全角半角の統一・小文字化・カタカナをひらがなに・空白記号の除去）"""
+    if not isinstance(value, str):
+        return ""
+    text = unicodedata.normalize("NFKC", value).lower()
+    # カタカナ（ァ〜ヶ）をひらがなに寄せる
+    text = "".join(chr(ord(c) - 0x60) if "ァ" <= c <= "ヶ" else c for c in text)
+    return "".join(c for c in text if c.isalnum() or c == "ー")
 
-    user_data = user_doc.to_dict()
-    return user_data.get("subscription", {})
+def make_search_ngrams(value) -> list:
+    """店舗名検索インデックス用のn-gram（1文字・2文字）を生成
 
-def get_user_by_line_id(line_user_id: str):
-    """LINE User IDからユーザーIDを取得"""
-    users = db.collection(config.COL_USERS).where("line_user_id", "==", line_user_id).limit(1).stream()
-    user_list = list(users)
+    上限を超える場合は先頭側を残す（前方からの検索語が一致し続けるように）。
+    """
+    text = normalize_search_text(value)
+    grams = []
+    seen = set()
+    for i in range(len(text)):
+        for gram in (text[i], text[i:i + 2]):
+            if gram in seen:
+                continue
+            seen.add(gram)
+            grams.append(gram)
+            if len(grams) >= config.VENDOR_NGRAMS_MAX:
+                return grams
+    return grams
 
-    if user_list:
-        return user_list[0].id
-    return None
+def normalize_record_fields(item: dict) -> dict:
+    """解析結果の日付・金額を検索可能な形式に揃え、店舗名の検索インデックスを付与"""
+    if "date" in item:
+        item["date"] = normalize_date(item["date"])
+    if "total_amount" in item:
+        try:
+            item["total_amount"] = normalize_amount(item["total_amount"])
+        except (ValueError, TypeError):
+            item["total_amount"] = 0
+    if "vendor_name" in item:
+        item["vendor_ngrams"] = make_search_ngrams(item["vendor_name"])
+    return item
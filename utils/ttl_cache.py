@@ -0,0 +1,64 @@
+"""
+TTL付きインメモリキャッシュ
+プロセス内で短時間だけ値を保持する（スレッドセーフ）
+"""
+import time
+import threading
+from collections import OrderedDict
+
+class TTLCache:
+    """有効期限付きのLRUキャッシュ"""
+
+    _MISSING = object()
+
+    def __init__(self, ttl_seconds: float, max_entries: int = 10000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """キーの値を取得（期限切れ・未登録ならdefault）"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key, self._MISSING)
+            if entry is self._MISSING or entry[0] <= now:
+                if entry is not self._MISSING:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl_seconds: float = None):
+        """キーに値を設定"""
+        expires_at = time.monotonic() + (ttl_seconds if ttl_seconds is not None else self.ttl_seconds)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """キーを削除"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """全エントリを削除"""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        """ヒット率などの統計情報を返す"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0
+            }